@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from gscript import AssignmentParser
+from gscript import AsyncExecutor
+from gscript import BatchExecutor
+from gscript import ConditionParser
+from gscript import ExpressionParser
+from gscript import FunctionCallParser
+from gscript import FunctionParser
+from gscript import GScriptExecutor
+from gscript import GScriptParser
+from gscript import LoopParser
+from gscript import ReturnParser
+from gscript import ScriptPool
+from gscript import VarExpressionParser
+
+PLUGINS = [FunctionParser, FunctionCallParser, ReturnParser, ConditionParser,
+           LoopParser, VarExpressionParser, AssignmentParser, ExpressionParser]
+
+SCORING_SCRIPT = """
+var score = price * quantity - discount;
+if (score > 500) {
+    var tier = 3;
+} else {
+    var tier = 1;
+}
+var i = 0;
+var total = 0;
+while (i < quantity) {
+    total = total + price / (i + 1);
+    i = i + 1;
+}
+"""
+
+
+def parse(code, hosts=()):
+    parser = GScriptParser(code)
+    for name in hosts:
+        parser.declare_function(name)
+    for plugin in PLUGINS:
+        parser.register_plugin(plugin)
+    return parser.parse()
+
+
+def best_of(function, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def scalar_rows(ast, columns, size):
+    for index in range(size):
+        executor = GScriptExecutor(ast)
+        executor.variables = {name: column[index] for name, column in columns.items()}
+        executor.execute()
+
+
+def bench_batch(sizes=(100, 1000, 10000)):
+    ast = parse(SCORING_SCRIPT)
+    for size in sizes:
+        columns = {
+            'price': [random.randint(1, 100) for _ in range(size)],
+            'quantity': [random.randint(1, 10) for _ in range(size)],
+            'discount': [random.randint(0, 50) for _ in range(size)],
+        }
+        batch = BatchExecutor(ast)
+        batch_time = best_of(lambda: batch.execute_batch(columns))
+        scalar_time = best_of(lambda: scalar_rows(ast, columns, size))
+        print(f'batch rows={size:<6} mode={batch.mode:<10} batch={batch_time * 1000:9.2f}ms '
+              f'scalar={scalar_time * 1000:9.2f}ms speedup={scalar_time / batch_time:6.1f}x')
+
+
+POOL_SCRIPT = """
+var i = 0;
+var total = 0;
+while (i < n) {
+    total = total + i * i;
+    i = i + 1;
+}
+"""
+
+
+def bench_pool(process_counts=(1, 2, 4), jobs=64, iterations=2000):
+    ast = parse(POOL_SCRIPT)
+    baseline = None
+    for processes in process_counts:
+        with ScriptPool(processes=processes, chunksize=4) as pool:
+            handle = pool.register(ast)
+            pool.map([(handle, {'n': 1})] * processes)
+            start = time.perf_counter()
+            results = pool.map([(handle, {'n': iterations})] * jobs)
+            elapsed = time.perf_counter() - start
+        assert all(error is None for _, _, _, error in results)
+        baseline = baseline or elapsed
+        print(f'pool processes={processes:<3} jobs={jobs} {jobs / elapsed:8.1f} jobs/s '
+              f'scaling={baseline / elapsed:5.2f}x')
+
+
+ASYNC_SCRIPT = """
+var i = 0;
+var total = 0;
+while (i < 4) {
+    total = total + fetch(i);
+    i = i + 1;
+}
+"""
+
+
+async def fetch(key):
+    await asyncio.sleep(0.005)
+    return key
+
+
+async def run_concurrently(ast, concurrency):
+    async def run_one():
+        executor = AsyncExecutor(ast, {'fetch': fetch})
+        await executor.execute()
+    await asyncio.gather(*[run_one() for _ in range(concurrency)])
+
+
+def bench_async(levels=(1, 10, 100, 1000)):
+    ast = parse(ASYNC_SCRIPT, hosts=('fetch',))
+    for concurrency in levels:
+        start = time.perf_counter()
+        asyncio.run(run_concurrently(ast, concurrency))
+        elapsed = time.perf_counter() - start
+        print(f'async concurrency={concurrency:<5} {elapsed * 1000:8.1f}ms {concurrency / elapsed:9.1f} runs/s')
+
+
+def function_name(index):
+    # GScript identifiers are letters only: ga, gb, ..., gz, gaa, ...; the lexer would
+    # split a name that starts with a keyword such as 'for'
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(97 + remainder) + letters
+    return 'g' + letters
+
+
+def many_functions(size):
+    definitions = [f'function {function_name(i)}(a, b) {{ return a + {i} * b; }}' for i in range(size)]
+    calls = [f'r = r + {function_name(i)}(r, 1);' for i in range(size)]
+    return '\n'.join(definitions) + '\nvar r = 0;\n' + '\n'.join(calls)
+
+
+def deep_expression(size):
+    expression = 'x'
+    for i in range(size):
+        expression = f'({expression} + {i % 7 + 1})'
+    return f'var x = 1;\nvar y = {expression};'
+
+
+def long_arguments(size):
+    params = ', '.join(function_name(i) for i in range(size))
+    args = ', '.join(str(i) for i in range(size))
+    return f'function h({params}) {{ return {function_name(0)} + {function_name(size - 1)}; }}\nvar r = h({args});'
+
+
+def nested_conditions(size):
+    body = 'r = r + 1;'
+    for i in range(size):
+        body = f'if (x > {i}) {{ {body} }} else {{ r = r - 1; }}'
+    return f'var x = {size * 2};\nvar r = 0;\n{body}'
+
+
+def long_loop(size):
+    return f'var i = 0;\nvar s = 0;\nwhile (i < {size}) {{ s = s + i * 2; i = i + 1; }}'
+
+
+GENERATORS = {
+    'functions': (many_functions, (10, 100, 400)),
+    'deep_expression': (deep_expression, (10, 50, 200)),
+    'arguments': (long_arguments, (5, 50, 200)),
+    'nested_conditions': (nested_conditions, (5, 20, 60)),
+    'loop': (long_loop, (1000, 10000, 50000)),
+}
+
+
+def bench_program(code, repeat):
+    timings = {}
+    parser = GScriptParser(code)
+    timings['tokenize'] = best_of(lambda: parser.tokenize(code), repeat)
+
+    def parse_once():
+        parser = GScriptParser(code)
+        for plugin in PLUGINS:
+            parser.register_plugin(plugin)
+        start = time.perf_counter()
+        ast = parser.parse()
+        return time.perf_counter() - start, ast
+
+    timings['parse'], ast = min(parse_once() for _ in range(repeat))
+    timings['execute'] = best_of(lambda: GScriptExecutor(ast).execute(), repeat)
+    return timings
+
+
+def run_suite(repeat=3, scale=1.0, only=None):
+    # deep expressions and nested conditions recurse once per level in the parser
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+    results = {}
+    for name, (generator, sizes) in GENERATORS.items():
+        if only and name not in only:
+            continue
+        for size in sizes:
+            size = max(1, int(size * scale))
+            code = generator(size)
+            timings = bench_program(code, repeat)
+            results[f'{name}/{size}'] = dict(timings, tokens=len(GScriptParser(code).tokens))
+            print(f'{name + "/" + str(size):<26}' + ''.join(
+                f'{phase}={timings[phase] * 1000:9.3f}ms ' for phase in ('tokenize', 'parse', 'execute')))
+    return results
+
+
+def compare(results, baseline, threshold):
+    # a phase regresses when it is more than threshold times slower than the baseline
+    regressions = []
+    for key, timings in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for phase in ('tokenize', 'parse', 'execute'):
+            if phase in previous and previous[phase] > 0 and timings[phase] > previous[phase] * threshold:
+                regressions.append((key, phase, previous[phase], timings[phase]))
+    for key, phase, before, after in regressions:
+        print(f'REGRESSION {key} {phase}: {before * 1000:.3f}ms -> {after * 1000:.3f}ms ({after / before:.2f}x)')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='GScript benchmarks')
+    commands = parser.add_subparsers(dest='benchmark')
+    suite = commands.add_parser('suite', help='tokenize/parse/execute over generated programs')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--scale', type=float, default=1.0, help='multiply every generator size')
+    suite.add_argument('--only', nargs='*', choices=sorted(GENERATORS))
+    suite.add_argument('--output', help='write results as JSON')
+    suite.add_argument('--baseline', help='compare against a JSON file written by --output')
+    suite.add_argument('--threshold', type=float, default=1.25)
+    for name in ('batch', 'pool', 'async'):
+        commands.add_parser(name).add_argument('counts', type=int, nargs='*')
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'batch':
+        bench_batch(args.counts or (100, 1000, 10000))
+    elif args.benchmark == 'pool':
+        bench_pool(args.counts or (1, 2, 4))
+    elif args.benchmark == 'async':
+        bench_async(args.counts or (1, 10, 100, 1000))
+    elif args.benchmark in (None, 'suite'):
+        if args.benchmark is None:
+            args = parser.parse_args(['suite'])
+        results = run_suite(args.repeat, args.scale, args.only)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump({'python': sys.version.split()[0], 'results': results}, file, indent=2, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as file:
+                baseline = json.load(file)['results']
+            if compare(results, baseline, args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,79 +1,518 @@
+import ast as ast_module
+import asyncio
+import codecs
+import hashlib
+import inspect
+import io
+import marshal
+import math
+import multiprocessing
+import operator
+import os
+import pickle
 import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import ChainMap, OrderedDict
+from functools import wraps
+from types import MappingProxyType
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TOKEN_SPECIFICATION = [
+    ('NUMBER',   r'\d+(\.\d*)?'),
+    ('ASSIGN',   r'='),
+    ('END',      r';'),
+    
+    ('RETURN',   r'return'),
+    ('IF',       r'if'),
+    ('ELSE',     r'else'),
+    ('WHILE',    r'while'),
+    ('FOR',      r'for'),
+    ('FUNCTION', r'function'),
+    
+    ('LE',       r'<'),
+    ('LEQ',       r'<='),
+    ('GE',       r'>'),
+    ('GEQ',       r'>='),
+    ('EQ',       r'=='),
+    
+    ('ID',       r'[A-Za-z]+'),
+    
+    ('OP',       r'[+\-*/]'),
+    ('LPAREN',   r'\('),
+    ('RPAREN',   r'\)'),
+    ('LBRACE',   r'\{'),
+    ('RBRACE',   r'\}'),
+    ('COMMA',    r','),
+    ('STRING',   r'"[^"]*"'),
+    ('NEWLINE',  r'\n'),
+    ('SKIP',     r'[ \t]+'),
+    ('MISMATCH', r'.'),
+]
+
+class SourceSpans:
+    # token i covers code[starts[i]:ends[i]], line/column are resolved on demand
+    def __init__(self, code, starts, ends) -> None:
+        self.code = code
+        self.starts = starts
+        self.ends = ends
+        self.line_starts = None
+        
+    def __len__(self):
+        return len(self.starts)
+    
+    def span(self, index):
+        return (self.starts[index], self.ends[index])
+    
+    def line_column(self, index):
+        return self.offset_line_column(self.starts[index])
+    
+    def offset_line_column(self, offset):
+        if self.line_starts is None:
+            line_starts = array('L', [0])
+            code = self.code
+            position = code.find('\n')
+            while position >= 0:
+                line_starts.append(position+1)
+                position = code.find('\n', position+1)
+            self.line_starts = line_starts
+        line = bisect_right(self.line_starts, offset)
+        return (line, offset - self.line_starts[line-1] + 1)
+
+class Lexer:
+    def __init__(self, token_specification) -> None:
+        self.token_specification = token_specification
+        self.regex = re.compile('|'.join('(?P<%s>%s)' % pair for pair in token_specification))
+        
+    def iter_tokens(self, code, start=0, end=None):
+        # lazily yields (kind, value, start, end), skipping blanks and newlines
+        if end is None:
+            end = len(code)
+        for mo in self.regex.finditer(code, start, end):
+            kind = mo.lastgroup
+            if kind != 'SKIP' and kind != 'NEWLINE':
+                yield (kind, mo.group(), mo.start(), mo.end())
+    
+    def tokenize(self, code):
+        return [(mo.lastgroup, mo.group()) for mo in self.regex.finditer(code)
+                if mo.lastgroup != 'SKIP' and mo.lastgroup != 'NEWLINE']
+    
+    def tokenize_with_spans(self, code):
+        tokens = []
+        starts = array('L')
+        ends = array('L')
+        for mo in self.regex.finditer(code):
+            kind = mo.lastgroup
+            if kind != 'SKIP' and kind != 'NEWLINE':
+                tokens.append((kind, mo.group()))
+                starts.append(mo.start())
+                ends.append(mo.end())
+        return tokens, SourceSpans(code, starts, ends)
+
+LEXER = Lexer(TOKEN_SPECIFICATION)
+
+def strip_position(expr):
+    # parsers wrap expressions as (expr, token position) pairs
+    while type(expr) is tuple and len(expr) == 2 and type(expr[1]) is int:
+        expr = expr[0]
+    return expr
+
+def flatten_arguments(args):
+    # FUNCTION_CALL arguments arrive as a list whose items may be ('COMMA', [...]) groups
+    flat = []
+    for arg in args:
+        if type(arg) is tuple and arg[0] == 'COMMA':
+            flat.extend(arg[1])
+        else:
+            flat.append(arg)
+    return flat
+
+def parse_number(text):
+    if '.' in text:
+        return float(text)
+    return int(text)
+
+def packrat(parse_expression):
+    # memoize a parse_expression by (rule, position) when the main parser runs in packrat mode
+    rule = parse_expression.__qualname__
+    
+    @wraps(parse_expression)
+    def memoized(self, tokens, position):
+        main_parser = self.main_parser
+        memo = main_parser.memo
+        if memo is None:
+            return parse_expression(self, tokens, position)
+        key = (rule, position)
+        if key in memo:
+            main_parser.memo_hits += 1
+            return memo[key]
+        main_parser.memo_misses += 1
+        result = parse_expression(self, tokens, position)
+        memo[key] = result
+        return result
+    return memoized
+
+class ParsedStatement:
+    # a top-level statement: its node, its token range and its character range. The
+    # character range counts from the start of the file for statements before the
+    # parser's gap and from the end of the file after it, so an edit at the gap moves
+    # no other statement. origin is where the statement started when its tokens were
+    # lexed; the stored token offsets are off by the distance it has moved since
+    __slots__ = ('node', 'token_start', 'token_end', 'start', 'end', 'origin', 'after')
+    
+    def __init__(self, node, token_start, token_end, start, end) -> None:
+        self.node = node
+        self.token_start = token_start
+        self.token_end = token_end
+        self.start = start
+        self.end = end
+        self.origin = start
+        self.after = False
 
 class GScriptParser:
-    def __init__(self, code):
+    def __init__(self, code, packrat=False, lazy_functions=False, builtins=None):
         self.code = code
-        self.tokens = self.tokenize(code)
+        self.lazy_functions = lazy_functions
+        self.builtins = builtins
+        self.lazy_bodies = []
+        self.source_spans = None
+        self.tokens, self.spans = LEXER.tokenize_with_spans(code)
         self.position = 0
         self.plugins = {}
         self.functions = {}
+        if builtins is not None:
+            for func_name in builtins.builtins:
+                self.declare_function(func_name)
+        self.skipped_attempts = 0
+        self.memo = {} if packrat else None
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.statements = []
+        self.gap = 0
+        self.definers = {}
+        self.live_tokens = 0
+        self.nested_imports = False
+        self.ast = []
+        self.declared = None
+        self.last_reparse = None
+        self.loader = None
+        self.build_dispatch()
+
+    @property
+    def spans(self):
+        # token offsets of statements moved by reparse are fixed up on first use
+        if self.source_spans is None:
+            starts, ends = array('L', self.raw_starts), array('L', self.raw_ends)
+            statements = self.statements
+            for statement in statements:
+                shift = self.statement_start(statement) - statement.origin
+                if shift:
+                    for index in range(statement.token_start, statement.token_end):
+                        starts[index] += shift
+                        ends[index] += shift
+            # positions point past the token they belong to, so the token after a
+            # reparsed region stands for the statement that follows it now
+            for index, statement in enumerate(statements):
+                following = statements[index + 1] if index + 1 < len(statements) else None
+                after = statement.token_end
+                if after < len(starts) and (following is None or following.token_start != after):
+                    if following is None:
+                        starts[after] = ends[after] = len(self.code)
+                    else:
+                        starts[after], ends[after] = starts[following.token_start], ends[following.token_start]
+            self.source_spans = SourceSpans(self.code, starts, ends)
+        return self.source_spans
+    
+    @spans.setter
+    def spans(self, spans):
+        self.source_spans = spans
+        self.raw_starts = spans.starts
+        self.raw_ends = spans.ends
 
     def tokenize(self, code):
-        token_specification = [
-            ('NUMBER',   r'\d+(\.\d*)?'),
-            ('ASSIGN',   r'='),
-            ('END',      r';'),
-            
-            ('RETURN',   r'return'),
-            ('IF',       r'if'),
-            ('ELSE',     r'else'),
-            ('WHILE',    r'while'),
-            ('FOR',      r'for'),
-            ('FUNCTION', r'function'),
-            
-            ('LE',       r'<'),
-            ('LEQ',       r'<='),
-            ('GE',       r'>'),
-            ('GEQ',       r'>='),
-            ('EQ',       r'=='),
-            
-            ('ID',       r'[A-Za-z]+'),
-            
-            ('OP',       r'[+\-*/]'),
-            ('LPAREN',   r'\('),
-            ('RPAREN',   r'\)'),
-            ('LBRACE',   r'\{'),
-            ('RBRACE',   r'\}'),
-            ('COMMA',    r','),
-            ('STRING',   r'"[^"]*"'),
-            ('NEWLINE',  r'\n'),
-            ('SKIP',     r'[ \t]+'),
-            ('MISMATCH', r'.'),
-        ]
-        tok_regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specification)
-        tokens = []
-        for mo in re.finditer(tok_regex, code):
-            kind = mo.lastgroup
-            value = mo.group()
-            if kind != 'SKIP' and kind != 'NEWLINE':
-                tokens.append((kind, value))
-        return tokens
+        return LEXER.tokenize(code)
+    
+    def reset(self, code):
+        # parse a new piece of code with the same plugins and function table
+        self.code = code
+        self.tokens, self.spans = LEXER.tokenize_with_spans(code)
+        self.position = 0
 
     def register_plugin(self, plugin):
         self.plugins[plugin.__name__] = plugin(self)
+        self.build_dispatch()
         
     def get_plugin(self, plugin):
         return self.plugins[plugin.__name__]
+    
+    def build_dispatch(self):
+        # map each token kind to the plugins that may start a statement with it,
+        # plugins without start_tokens are tried for every kind. Each candidate comes with
+        # the number of plugins before it that trying every plugin in order would have
+        # attempted first, so a match adds what the dispatch actually saved
+        plugins = list(self.plugins.values())
+        kinds = set()
+        for plugin in plugins:
+            kinds.update(getattr(plugin, 'start_tokens', None) or ())
+        
+        def candidates(kind, skip_functions):
+            result = []
+            skipped = 0
+            for plugin in plugins:
+                if skip_functions and isinstance(plugin, FunctionParser):
+                    continue
+                start_tokens = getattr(plugin, 'start_tokens', None)
+                if start_tokens is None or kind in start_tokens:
+                    result.append((plugin, skipped))
+                else:
+                    skipped += 1
+            return result
+        
+        self.dispatch = {kind: candidates(kind, False) for kind in kinds}
+        self.dispatch_default = candidates(None, False)
+        self.body_dispatch = {kind: candidates(kind, True) for kind in kinds}
+        self.body_dispatch_default = candidates(None, True)
+    
+    def candidates(self, kind):
+        # (plugin, skipped) pairs; add skipped to skipped_attempts when plugin matches
+        return self.dispatch.get(kind, self.dispatch_default)
+    
+    def body_candidates(self, kind):
+        return self.body_dispatch.get(kind, self.body_dispatch_default)
+
+    def stats(self):
+        return {
+            'skipped_attempts': self.skipped_attempts,
+            'memo_hits': self.memo_hits,
+            'memo_misses': self.memo_misses,
+            'memo_size': 0 if self.memo is None else len(self.memo),
+        }
 
     def parse(self):
+        if self.memo is not None:
+            self.memo = {}
+        if self.declared is None:
+            # functions known before any definition, e.g. builtins; kept for reparse
+            self.declared = dict(self.functions)
+        self.nested_imports = False
         ast = []
-        while self.position < len(self.tokens):
+        ranges = []
+        self.parse_statements(ast, ranges, len(self.tokens))
+        self.ast = ast
+        starts, ends = self.raw_starts, self.raw_ends
+        self.statements = [ParsedStatement(node, start, end, starts[start], ends[end - 1])
+                           for node, (start, end) in zip(ast, ranges)]
+        self.gap = len(self.statements)
+        self.live_tokens = len(self.tokens)
+        self.definers = {}
+        for statement in self.statements:
+            for func_name in self.defined_names(statement.node):
+                self.definers.setdefault(func_name, []).append(statement)
+        return ast
+    
+    def parse_statements(self, ast, ranges, end):
+        # parses top-level statements from self.position until it reaches end,
+        # recording the token range of each statement
+        while self.position < end:
+            start = self.position
             token = self.tokens[self.position]
-            for name in self.plugins:
-                plugin = self.plugins[name]
+            for plugin, skipped in self.candidates(token[0]):
                 result = plugin.parse()
                 # print("parse:", plugin, self.position, token, result)
                 if result is not None:
+                    self.skipped_attempts += skipped
                     # print("parse:", plugin, self.position, token, result)
                     ast.append(result)
+                    ranges.append((start, self.position))
                     break
             else:
                 message = f'Unexpected token {token} at position {self.position}'
                 print(message)
                 raise RuntimeError(message)
-        return ast
+    
+    def reparse(self, start, end, text):
+        # replaces code[start:end] with text. Only the statements around the edit are
+        # re-lexed and re-parsed; their tokens are appended to the token list, so every
+        # other statement keeps its node and token positions, and the ast list is updated
+        # in place. Falls back to a full parse whenever the edit may change how the rest
+        # of the file parses
+        code = self.code[:start] + text + self.code[end:]
+        result = self.reparse_region(code, start, end, len(text) - (end - start))
+        if result is None:
+            self.last_reparse = {'mode': 'full'}
+            self.code = code
+            self.tokens, self.spans = LEXER.tokenize_with_spans(code)
+            self.position = 0
+            self.lazy_bodies = []
+            self.functions.clear()
+            self.functions.update(self.declared or {})
+            return self.parse()
+        return result
+    
+    def statement_start(self, statement):
+        return statement.start + len(self.code) if statement.after else statement.start
+    
+    def statement_end(self, statement):
+        return statement.end + len(self.code) if statement.after else statement.end
+    
+    def move_gap(self, index):
+        # statements from index on count their characters from the end of the file
+        length = len(self.code)
+        for statement in self.statements[index:self.gap]:
+            statement.start -= length
+            statement.end -= length
+            statement.after = True
+        for statement in self.statements[self.gap:index]:
+            statement.start += length
+            statement.end += length
+            statement.after = False
+        self.gap = index
+    
+    def defined_names(self, node):
+        # the function names a top-level statement adds to the function table
+        if node[0] == 'FUNCTION_DEF':
+            return (node[1],)
+        if node[0] == 'IMPORT' and self.loader is not None:
+            return tuple(self.loader.load(node[1]).functions)
+        return ()
+    
+    def function_entry(self, func_name, before=None):
+        # the function table entry for func_name as a parse sees it at statement before,
+        # or at the end of the file
+        entry = self.declared.get(func_name)
+        for statement in self.definers.get(func_name, ()):
+            if before is not None and self.statement_start(statement) >= self.statement_start(before):
+                break
+            node = statement.node
+            if node[0] == 'FUNCTION_DEF':
+                entry = (node[2], node[3])
+            elif entry is None:
+                entry = (list(self.loader.load(node[1]).functions[func_name][0]), None)
+        return entry
+    
+    def set_function_entries(self, names, before=None):
+        functions = self.functions
+        for func_name in names:
+            entry = self.function_entry(func_name, before)
+            if entry is None:
+                functions.pop(func_name, None)
+            else:
+                functions[func_name] = entry
+    
+    def reparse_region(self, code, start, end, delta):
+        statements = self.statements
+        if not statements or self.declared is None or self.nested_imports:
+            return None
+        if len(self.tokens) > 2 * self.live_tokens + 1024:
+            # a full parse drops the tokens of replaced regions once they dominate
+            return None
+        if '"' in self.code[start:end] or '"' in code[start:start + end - start + delta]:
+            # a quote can pair up with one far away and re-lex the rest of the file
+            return None
+        count = len(statements)
+        # one extra statement on each side covers edits that join or split statements,
+        # e.g. an else added after an if
+        first = max(bisect_left(statements, start, key=self.statement_end) - 1, 0)
+        last = min(bisect_right(statements, end, key=self.statement_start), count - 1)
+        char_start = min(self.statement_start(statements[first]), start)
+        char_end = max(self.statement_end(statements[last]), end) + delta
+        if (char_start > 0 and (code[char_start - 1].isalnum() or code[char_start - 1] == '.')
+                or char_end < len(code) and (code[char_end].isalnum() or code[char_end] == '.')):
+            return None
+        region_tokens, region_spans = LEXER.tokenize_with_spans(code[char_start:char_end])
+        
+        # the region goes after every stored token, followed by the first tokens of the
+        # next statement as the lookahead the region's last statement would see in place
+        tokens, raw_starts, raw_ends = self.tokens, self.raw_starts, self.raw_ends
+        if statements[-1].token_end == len(tokens):
+            # a placeholder keeps the position after the last statement its own
+            tokens.append(('SKIP', ''))
+            raw_starts.append(0)
+            raw_ends.append(0)
+        base = len(tokens)
+        region_end = base + len(region_tokens)
+        tokens.extend(region_tokens)
+        raw_starts.extend(array('L', [offset + char_start for offset in region_spans.starts]))
+        raw_ends.extend(array('L', [offset + char_start for offset in region_spans.ends]))
+        if last + 1 < count:
+            following = statements[last + 1]
+            lookahead = tokens[following.token_start:min(following.token_start + 16, following.token_end)]
+            tokens.extend(lookahead)
+            raw_starts.extend(array('L', [0]) * len(lookahead))
+            raw_ends.extend(array('L', [0]) * len(lookahead))
+        # calls only parse against functions defined earlier in the file
+        names = {value for kind, value in region_tokens if kind == 'ID'}
+        self.set_function_entries(names, statements[first])
+        if self.memo is not None:
+            self.memo = {}
+        new_ast, new_ranges = [], []
+        self.position = base
+        try:
+            self.parse_statements(new_ast, new_ranges, region_end)
+        except Exception:
+            # the full parse below reports the error against the whole file
+            new_ast = None
+        replaced = statements[first:last + 1]
+        defining = lambda nodes: [(node[0], node[1]) for node in nodes
+                                  if node[0] == 'FUNCTION_DEF' or node[0] == 'IMPORT']
+        if (new_ast is None or self.position != region_end or self.nested_imports
+                or defining(new_ast) != defining([statement.node for statement in replaced])):
+            # a statement that ran into the next one, or a definition or import that
+            # appeared, vanished or was renamed, changes how the rest of the file parses
+            del tokens[base:], raw_starts[base:], raw_ends[base:]
+            self.set_function_entries(names)
+            return None
+        
+        new_statements = [ParsedStatement(node, token_start, token_end, raw_starts[token_start], raw_ends[token_end - 1])
+                          for node, (token_start, token_end) in zip(new_ast, new_ranges)]
+        old_definers = [statement for statement in replaced if self.defined_names(statement.node)]
+        new_definers = [statement for statement in new_statements if self.defined_names(statement.node)]
+        for old, new in zip(old_definers, new_definers):
+            for func_name in self.defined_names(new.node):
+                definers = self.definers[func_name]
+                definers[definers.index(old)] = new
+        self.move_gap(last + 1)
+        statements[first:last + 1] = new_statements
+        self.gap = first + len(new_statements)
+        self.set_function_entries(names)
+        self.ast[first:last + 1] = new_ast
+        self.live_tokens += len(region_tokens) - sum(statement.token_end - statement.token_start
+                                                     for statement in replaced)
+        self.code = code
+        self.source_spans = None
+        self.position = len(tokens)
+        self.last_reparse = {
+            'mode': 'incremental',
+            'statements': len(new_ast),
+            'reused': len(self.ast) - len(new_ast),
+            'tokens': len(region_tokens),
+        }
+        return self.ast
+    
+    def parse_nodes(self):
+        return nodes_from_tuples(self.parse())
+    
+    def parse_program(self):
+        return Program(self.parse(), self.builtins)
+    
+    def declare_function(self, func_name, params=()):
+        # makes calls to a function the script does not define (e.g. a host function) parse
+        self.functions.setdefault(func_name, (list(params), None))
 
 class AssignmentParser:
+    start_tokens = ('ID',)
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -92,6 +531,7 @@ class AssignmentParser:
         else:
             return None
     
+    @packrat
     def parse_expression(self, tokens, position):
         if tokens[position][0] == 'ID':
             var_name = tokens[position][1]
@@ -99,7 +539,7 @@ class AssignmentParser:
             if tokens[position][0] == 'ASSIGN':
                 position += 1
                 
-                if tokens[position][0]=='NUMBER':
+                if tokens[position][0]=='NUMBER' and position+1 < len(tokens) and tokens[position+1][0]=='END':
                     return (('ASSIGN', var_name, tokens[position][1]), position+1)
                 
                 func = self.main_parser.get_plugin(FunctionCallParser)
@@ -109,8 +549,6 @@ class AssignmentParser:
                     new_position  = result[1]
                     if tokens[new_position][0] == 'END':
                         return (('ASSIGN', var_name, var_value), new_position+1)
-                    else:
-                        assert False
                 
                 exp = ExpressionParser(self.main_parser)
                 result = exp.parse_expression(tokens, position)
@@ -126,6 +564,8 @@ class AssignmentParser:
         return None
 
 class ArithmeticExpressionParser:
+    start_tokens = ('NUMBER', 'LPAREN', 'ID')
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -143,21 +583,23 @@ class ArithmeticExpressionParser:
             return ('EXPR', result[0])
         return None
 
+    @packrat
     def parse_expression(self, tokens, position):
         result = self.parse_term(tokens, position)
         
         if result is None:
             return None
         
-        position = result[1]
-        while result is not None and position < len(tokens) and tokens[position][0] == 'OP' and tokens[position][1] in '+-':
+        value, position = result
+        while position < len(tokens) and tokens[position][0] == 'OP' and tokens[position][1] in '+-':
             op = tokens[position][1]
             term_result = self.parse_term(tokens, position+1)
             if term_result is None:
                 break
             
-            result = (op, result[0], term_result[0])
+            value = (op, value, term_result[0])
             position = term_result[1]
+            result = value
         
         return (result, position)
 
@@ -166,30 +608,37 @@ class ArithmeticExpressionParser:
         if result is None:
             return None
         
-        position = result[1]
-        while result is not None and position < len(tokens) and tokens[position][0] == 'OP' and tokens[position][1] in '*/':
+        value, position = result
+        while position < len(tokens) and tokens[position][0] == 'OP' and tokens[position][1] in '*/':
             op = tokens[position][1]
             factor_result = self.parse_factor(tokens, position+1)
             if factor_result is None:
                 return None
-            result = (op, result[0], factor_result[0])
+            value = (op, value, factor_result[0])
             position = factor_result[1]
             
-        return result
+        return (value, position)
         
     def parse_factor(self, tokens, position):
         if tokens[position][0] == 'NUMBER':
-            return (int(tokens[position][1]), position + 1)
+            return (parse_number(tokens[position][1]), position + 1)
         elif tokens[position][0] == 'LPAREN':
             position += 1
             result = self.parse_expression(tokens, position)
             if result is not None and tokens[result[1]][0] == 'RPAREN':
-                return (result[0], result[1])
+                return (strip_position(result[0]), result[1] + 1)
         elif tokens[position][0] == 'ID':
+            if position+1 < len(tokens) and tokens[position+1][0] == 'LPAREN' and tokens[position][1] in self.main_parser.functions:
+                call = FunctionCallParser(self.main_parser)
+                result = call.parse_expression(tokens, position)
+                if result is not None:
+                    return result
             return (tokens[position][1], position + 1)
         return None
 
 class CommaExpressionParser:
+    start_tokens = ('STRING', 'NUMBER', 'LPAREN', 'ID')
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -206,6 +655,7 @@ class CommaExpressionParser:
             return result
         return None
     
+    @packrat
     def parse_expression(self, tokens, position):
         comma_exps = []
         
@@ -235,6 +685,8 @@ class CommaExpressionParser:
         return (('COMMA', comma_exps), position)
     
 class VarExpressionParser:
+    start_tokens = ('ID',)
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -267,7 +719,52 @@ class VarExpressionParser:
             
         return None
 
+class ImportParser:
+    start_tokens = ('ID',)
+    
+    def __init__(self, main_parser) -> None:
+        self.main_parser = main_parser
+        self.top_level = False
+        
+    def parse(self):
+        main_parser = self.main_parser
+        tokens = main_parser.tokens
+        position = main_parser.position
+        
+        self.top_level = True
+        try:
+            result = self.parse_expression(tokens, position)
+        finally:
+            self.top_level = False
+        if result is not None:
+            new_postion = result[1]
+            if new_postion < len(tokens) and tokens[new_postion][0]=='END':
+                new_postion+=1
+            main_parser.position = new_postion
+            return result[0]
+        else:
+            return None
+        
+    def parse_expression(self, tokens, position):
+        if (tokens[position][0] == 'ID' and tokens[position][1] == 'import'
+                and position+1 < len(tokens) and tokens[position+1][0] == 'STRING'):
+            module_name = tokens[position+1][1][1:-1]
+            main_parser = self.main_parser
+            if main_parser.loader is None:
+                main_parser.loader = ModuleLoader.default([type(plugin) for plugin in main_parser.plugins.values()])
+            if not self.top_level:
+                # reparse tracks only the imports of top-level statements
+                main_parser.nested_imports = True
+            # the module's functions must be known before calls to them can parse
+            module = main_parser.loader.load(module_name)
+            for func_name, (params, _) in module.functions.items():
+                main_parser.functions.setdefault(func_name, (list(params), None))
+            return (('IMPORT', module_name), position + 2)
+        return None
+
 class ExpressionParser:
+    start_tokens = ('STRING', 'NUMBER', 'LPAREN', 'ID')
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -314,20 +811,20 @@ class BodyParser:
             position += 1
             
             while tokens[position][0] != self.right:
-                plugins = self.main_parser.plugins
-                for name in plugins:
-                    plugin = plugins[name]
-                    if isinstance(plugin, FunctionParser):
-                        continue
-                    
+                for plugin, skipped in self.main_parser.body_candidates(tokens[position][0]):
                     result = plugin.parse_expression(tokens, position)
                     
                     if result is not None:
+                        self.main_parser.skipped_attempts += skipped
                         body.append(result[0])
                         position = result[1]
                         if position<len(tokens) and tokens[position][0]=='END':
                             position+=1
                         break
+                else:
+                    message = f'Unexpected token {tokens[position]} at position {position}'
+                    print(message)
+                    raise RuntimeError(message)
                 
             if position<len(tokens) and tokens[position][0]==self.right:
                 position+=1
@@ -335,6 +832,8 @@ class BodyParser:
             return (("BLOCK", body), position)
 
 class ConditionParser:
+    start_tokens = ('IF',)
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -395,6 +894,8 @@ class ConditionParser:
         return None
     
 class CompareParaer:
+    start_tokens = ('STRING', 'NUMBER', 'LPAREN', 'ID')
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -413,6 +914,7 @@ class CompareParaer:
         else:
             return None
         
+    @packrat
     def parse_expression(self, tokens, position):
         exp_left = ExpressionParser(self.main_parser)
         exp_right = ExpressionParser(self.main_parser)
@@ -431,6 +933,8 @@ class CompareParaer:
         return None
 
 class LoopParser:
+    start_tokens = ('WHILE', 'FOR')
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -455,9 +959,9 @@ class LoopParser:
             if tokens[position][0] == 'LPAREN':
                 position += 1
                 expr_parser = CompareParaer(self.main_parser)
-                condition, new_position = expr_parser.parse_expression(tokens, position)
-                if condition is not None:
-                    position = new_position
+                result = expr_parser.parse_expression(tokens, position)
+                if result is not None:
+                    condition, position = result
                     if tokens[position][0] == 'RPAREN':
                         position += 1
                         
@@ -465,7 +969,7 @@ class LoopParser:
                         body_result = body_parser.parse_expression(tokens, position)
                         if body_result is not None:
                             body, new_position = body_result[0], body_result[1]
-                            (('WHILE', condition, body), new_position)
+                            return (('WHILE', condition, body), new_position)
                             
         elif tokens[position][0] == 'FOR':
             position += 1
@@ -473,33 +977,41 @@ class LoopParser:
                 position += 1
                 
                 assign_parser = AssignmentParser(self.main_parser)
-                init, new_position = assign_parser.parse_expression(tokens, position)
+                result = assign_parser.parse_expression(tokens, position)
                 
-                if init is not None:
-                    position = new_position
+                if result is not None:
+                    init, position = result
+                    if tokens[position][0] == 'END':
+                        position += 1
                     
                     expr_parser = CompareParaer(self.main_parser)
-                    condition, new_position = expr_parser.parse_expression(tokens, position)
-                    if condition is not None:
-                        position = new_position
+                    result = expr_parser.parse_expression(tokens, position)
+                    if result is not None:
+                        condition, position = result
                         if tokens[position][0] == 'END':
                             position += 1
                             
-                            assign_parser = AssignmentParser(self.main_parser)
-                            increment, new_position = assign_parser.parse_expression(tokens, position)
-                            if increment is not None:
-                                position = new_position
-                                if tokens[position][0] == 'RPAREN':
-                                    position += 1
-                                    
-                                    body_parser = BodyParser(self.main_parser, "LBRACE", "RBRACE")
-                                    body_result = body_parser.parse_expression(tokens, position)
-                                    if body_result is not None:
-                                        body, new_position = body_result[0], body_result[1]
-                                        (('FOR', init, condition, increment, body), new_position)
+                            # the increment is closed by ')' rather than ';'
+                            if tokens[position][0] == 'ID' and tokens[position+1][0] == 'ASSIGN':
+                                var_name = tokens[position][1]
+                                exp = ExpressionParser(self.main_parser)
+                                result = exp.parse_expression(tokens, position+2)
+                                if result is not None:
+                                    increment = ('ASSIGN', var_name, result[0])
+                                    position = result[1]
+                                    if tokens[position][0] == 'RPAREN':
+                                        position += 1
+                                        
+                                        body_parser = BodyParser(self.main_parser, "LBRACE", "RBRACE")
+                                        body_result = body_parser.parse_expression(tokens, position)
+                                        if body_result is not None:
+                                            body, new_position = body_result[0], body_result[1]
+                                            return (('FOR', init, condition, increment, body), new_position)
         return None
 
 class ReturnParser:
+    start_tokens = ('RETURN',)
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         
@@ -531,6 +1043,8 @@ class ReturnParser:
         return None
         
 class FunctionParser:
+    start_tokens = ('FUNCTION',)
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         self.functions = self.main_parser.functions
@@ -576,6 +1090,19 @@ class FunctionParser:
                     
                     position += 1
                     
+                    if self.main_parser.lazy_functions:
+                        body = LazyBody.scan(self.main_parser, tokens, position)
+                        if body is None:
+                            return None
+                        self.main_parser.lazy_bodies.append(body)
+                        self.functions[func_name] = (params, body)
+                        # the body parses later, but only against the functions known here
+                        body.functions = dict(self.functions)
+                        return (('FUNCTION_DEF', func_name, params, body), body.end + 1)
+                    
+                    # declared before the body is parsed so that recursive calls resolve
+                    previous = self.functions.get(func_name)
+                    self.functions[func_name] = (params, previous[1] if previous else None)
                     body_parser = BodyParser(self.main_parser, "LBRACE", "RBRACE")
                     body_result = body_parser.parse_expression(tokens, position)
                     
@@ -583,9 +1110,107 @@ class FunctionParser:
                         body, new_position = body_result[0], body_result[1]
                         self.functions[func_name] = (params, body)
                         return (('FUNCTION_DEF', func_name, params, body), new_position)
+                    if previous is None:
+                        del self.functions[func_name]
+                    else:
+                        self.functions[func_name] = previous
+        return None
+    
+class LazyBody:
+    # stands in for a function's ('BLOCK', [...]) until it is first indexed. Bodies of
+    # imported modules are shared between threads, so they resolve under a lock. functions
+    # is the parser's function table as it was at the definition, like an eager parse sees it
+    LOCK = threading.RLock()
+    
+    def __init__(self, main_parser, start, end, functions=None) -> None:
+        self.main_parser = main_parser
+        self.tokens = main_parser.tokens
+        self.start = start
+        self.end = end
+        self.functions = functions
+        self.body = None
+    
+    @classmethod
+    def scan(cls, main_parser, tokens, position):
+        if position >= len(tokens) or tokens[position][0] != 'LBRACE':
+            return None
+        depth = 0
+        for index in range(position, len(tokens)):
+            kind = tokens[index][0]
+            if kind == 'LBRACE':
+                depth += 1
+            elif kind == 'RBRACE':
+                depth -= 1
+                if depth == 0:
+                    return cls(main_parser, position, index)
         return None
     
+    @property
+    def resolved(self):
+        return self.body is not None
+    
+    @property
+    def empty(self):
+        # an unparsed body is empty when its braces are adjacent tokens
+        if self.body is None:
+            return self.end == self.start + 1
+        return not self.body[1]
+    
+    def resolve(self):
+        if self.body is None:
+            with self.LOCK:
+                if self.body is None:
+                    main_parser = self.main_parser
+                    # plugins share the parser's table, so it is swapped in place
+                    functions = main_parser.functions
+                    current = dict(functions)
+                    if self.functions is not None:
+                        functions.clear()
+                        functions.update(self.functions)
+                    # memo entries of a later parse may stand for other tokens
+                    memo = main_parser.memo
+                    if memo is not None:
+                        main_parser.memo = {}
+                    try:
+                        body_parser = BodyParser(main_parser, "LBRACE", "RBRACE")
+                        result = body_parser.parse_expression(self.tokens, self.start)
+                    finally:
+                        functions.clear()
+                        functions.update(current)
+                        main_parser.memo = memo
+                    if result is None or result[1] != self.end + 1:
+                        message = f'Cannot parse function body at position {self.start}'
+                        raise RuntimeError(message)
+                    self.main_parser = None
+                    self.tokens = None
+                    self.functions = None
+                    self.body = result[0]
+        return self.body
+    
+    def __getitem__(self, index):
+        return self.resolve()[index]
+    
+    def __len__(self):
+        return 2
+    
+    def __iter__(self):
+        return iter(self.resolve())
+    
+    def __eq__(self, other):
+        return self.resolve() == other
+    
+    def __repr__(self):
+        if self.body is None:
+            return f'LazyBody({self.start}, {self.end})'
+        return repr(self.body)
+    
+    def __reduce__(self):
+        # pickles as the plain body so programs can be sent to other processes
+        return tuple, (tuple(self.resolve()),)
+
 class FunctionCallParser:
+    start_tokens = ('ID',)
+    
     def __init__(self, main_parser) -> None:
         self.main_parser = main_parser
         self.functions = self.main_parser.functions
@@ -604,6 +1229,7 @@ class FunctionCallParser:
         else:
             return None
 
+    @packrat
     def parse_expression(self, tokens, position):
         if tokens[position][0] == 'ID' and tokens[position][1] in self.functions:
             func_name = tokens[position][1]
@@ -634,78 +1260,3552 @@ class FunctionCallParser:
                 return (('FUNCTION_CALL', func_name, args), position+1)
         return None
 
-class GScriptExecutor:
-    def __init__(self, ast):
-        self.ast = ast
-        self.variables = {}
-        self.functions = {}
+class Node:
+    __slots__ = ('position',)
+    fields = ()
+    
+    def __init__(self, *values, position=None) -> None:
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+        self.position = position
+        
+    def __repr__(self):
+        return f'{type(self).__name__}({", ".join(repr(getattr(self, field)) for field in self.fields)})'
+    
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, field) == getattr(other, field) for field in self.fields)
 
-    def execute(self):
-        for node in self.ast:
-            self.execute_node(node)
+class FunctionDefNode(Node):
+    __slots__ = fields = ('name', 'params', 'body')
 
-    def execute_node(self, node):
+class VarNode(Node):
+    __slots__ = fields = ('target',)
+
+class AssignNode(Node):
+    __slots__ = fields = ('name', 'value')
+
+class BlockNode(Node):
+    __slots__ = fields = ('statements',)
+
+class ConditionNode(Node):
+    __slots__ = fields = ('test', 'body', 'orelse')
+
+class WhileNode(Node):
+    __slots__ = fields = ('test', 'body')
+
+class ForNode(Node):
+    __slots__ = fields = ('init', 'test', 'increment', 'body')
+
+class ReturnNode(Node):
+    __slots__ = fields = ('value',)
+
+class ExprNode(Node):
+    __slots__ = fields = ('value',)
+
+class FunctionCallNode(Node):
+    __slots__ = fields = ('name', 'args')
+
+class BinOpNode(Node):
+    __slots__ = fields = ('op', 'left', 'right')
+
+class CompareNode(Node):
+    __slots__ = fields = ('op', 'left', 'right')
+
+class CommaNode(Node):
+    __slots__ = fields = ('items',)
+
+class NameNode(Node):
+    __slots__ = fields = ('name',)
+
+class NumberNode(Node):
+    __slots__ = fields = ('value',)
+
+class StringNode(Node):
+    __slots__ = fields = ('value',)
+
+class ImportNode(Node):
+    __slots__ = fields = ('name',)
+
+def node_from_tuple(node):
+    # tuple AST -> typed nodes, (expr, position) pairs become the position attribute
+    position = None
+    while type(node) is tuple and len(node) == 2 and type(node[1]) is int:
+        node, position = node
+    if node is None:
+        return None
+    if type(node) is bool or type(node) is int or type(node) is float:
+        return NumberNode(node, position=position)
+    if type(node) is str:
+        if node[:1].isdigit():
+            return NumberNode(parse_number(node), position=position)
+        return NameNode(node, position=position)
+    tag = node[0]
+    if tag == 'FUNCTION_DEF':
+        return FunctionDefNode(node[1], list(node[2]), node_from_tuple(node[3]), position=position)
+    elif tag == 'VAR':
+        return VarNode(node_from_tuple(node[1]), position=position)
+    elif tag == 'ASSIGN':
+        return AssignNode(node[1], node_from_tuple(node[2]), position=position)
+    elif tag == 'BLOCK':
+        return BlockNode([node_from_tuple(item) for item in node[1]], position=position)
+    elif tag == 'CONDITION':
+        return ConditionNode(node_from_tuple(node[1]), node_from_tuple(node[2]), node_from_tuple(node[3]), position=position)
+    elif tag == 'IF':
+        return ConditionNode(node_from_tuple(node[1]), node_from_tuple(node[2]), None, position=position)
+    elif tag == 'WHILE':
+        return WhileNode(node_from_tuple(node[1]), node_from_tuple(node[2]), position=position)
+    elif tag == 'FOR':
+        return ForNode(*[node_from_tuple(item) for item in node[1:]], position=position)
+    elif tag == 'RETURN':
+        return ReturnNode(node_from_tuple(node[1]), position=position)
+    elif tag == 'EXPR':
+        return ExprNode(node_from_tuple(node[1]), position=position)
+    elif tag == 'FUNCTION_CALL':
+        args = [node_from_tuple(arg) for arg in flatten_arguments(node[2])]
+        return FunctionCallNode(node[1], args, position=position)
+    elif tag == 'COMPARE':
+        return CompareNode(node[1], node_from_tuple(node[2]), node_from_tuple(node[3]), position=position)
+    elif tag == 'COMMA':
+        return CommaNode([node_from_tuple(item) for item in node[1]], position=position)
+    elif tag == 'STRING':
+        return StringNode(node[1][1:-1], position=position)
+    elif tag == 'IMPORT':
+        return ImportNode(node[1], position=position)
+    elif len(node) == 3 and tag in BINARY_OPERATORS:
+        return BinOpNode(tag, node_from_tuple(node[1]), node_from_tuple(node[2]), position=position)
+    message = f'Unknown AST node {node!r}'
+    raise RuntimeError(message)
+
+def node_to_tuple(node):
+    if node is None:
+        return None
+    kind = type(node)
+    if kind is FunctionDefNode:
+        result = ('FUNCTION_DEF', node.name, list(node.params), node_to_tuple(node.body))
+    elif kind is VarNode:
+        result = ('VAR', node_to_tuple(node.target))
+    elif kind is AssignNode:
+        result = ('ASSIGN', node.name, node_to_tuple(node.value))
+    elif kind is BlockNode:
+        result = ('BLOCK', [node_to_tuple(item) for item in node.statements])
+    elif kind is ConditionNode:
+        result = ('CONDITION', node_to_tuple(node.test), node_to_tuple(node.body), node_to_tuple(node.orelse))
+    elif kind is WhileNode:
+        result = ('WHILE', node_to_tuple(node.test), node_to_tuple(node.body))
+    elif kind is ForNode:
+        result = ('FOR', node_to_tuple(node.init), node_to_tuple(node.test), node_to_tuple(node.increment), node_to_tuple(node.body))
+    elif kind is ReturnNode:
+        result = ('RETURN', node_to_tuple(node.value))
+    elif kind is ExprNode:
+        result = ('EXPR', node_to_tuple(node.value))
+    elif kind is FunctionCallNode:
+        args = [node_to_tuple(arg) for arg in node.args]
+        result = ('FUNCTION_CALL', node.name, [('COMMA', args)] if len(args) > 1 else args)
+    elif kind is CompareNode:
+        result = ('COMPARE', node.op, node_to_tuple(node.left), node_to_tuple(node.right))
+    elif kind is CommaNode:
+        result = ('COMMA', [node_to_tuple(item) for item in node.items])
+    elif kind is BinOpNode:
+        result = (node.op, node_to_tuple(node.left), node_to_tuple(node.right))
+    elif kind is StringNode:
+        result = ('STRING', f'"{node.value}"')
+    elif kind is NumberNode:
+        result = node.value
+    elif kind is NameNode:
+        result = node.name
+    elif kind is ImportNode:
+        result = ('IMPORT', node.name)
+    else:
+        message = f'Unknown AST node {node!r}'
+        raise RuntimeError(message)
+    if node.position is not None:
+        return (result, node.position)
+    return result
+
+def nodes_from_tuples(ast):
+    return [node_from_tuple(node) for node in ast]
+
+def nodes_to_tuples(nodes):
+    return [node_to_tuple(node) for node in nodes]
+
+NODE_KINDS = [
+    FunctionDefNode, VarNode, AssignNode, BlockNode, ConditionNode, WhileNode, ForNode, ReturnNode,
+    ExprNode, FunctionCallNode, BinOpNode, CompareNode, CommaNode, NameNode, NumberNode, StringNode,
+    ImportNode,
+]
+
+class NodeArena:
+    # nodes stored column-wise: a kind byte, four int operands and a token position per node;
+    # operands index other nodes, the interned values table or the children array
+    def __init__(self) -> None:
+        self.kinds = array('B')
+        self.a = array('i')
+        self.b = array('i')
+        self.c = array('i')
+        self.d = array('i')
+        self.positions = array('i')
+        self.children = array('i')
+        self.values = []
+        self.value_index = {}
+        
+    def __len__(self):
+        return len(self.kinds)
+    
+    def nbytes(self):
+        columns = (self.kinds, self.a, self.b, self.c, self.d, self.positions, self.children)
+        return sum(column.itemsize * len(column) for column in columns)
+    
+    @classmethod
+    def from_nodes(cls, nodes):
+        arena = cls()
+        roots = arena.add_list(nodes)
+        return arena, roots
+    
+    def value(self, value):
+        key = (type(value), value)
+        index = self.value_index.get(key)
+        if index is None:
+            index = self.value_index[key] = len(self.values)
+            self.values.append(value)
+        return index
+    
+    def add_list(self, nodes):
+        indexes = [self.add(node) for node in nodes]
+        start = len(self.children)
+        self.children.extend(indexes)
+        return (start, len(indexes))
+    
+    def add(self, node):
+        if node is None:
+            return -1
+        kind = type(node)
+        a = b = c = d = -1
+        if kind is NameNode or kind is ImportNode:
+            a = self.value(node.name)
+        elif kind is NumberNode or kind is StringNode:
+            a = self.value(node.value)
+        elif kind is BinOpNode or kind is CompareNode:
+            a, b, c = self.value(node.op), self.add(node.left), self.add(node.right)
+        elif kind is FunctionCallNode:
+            a = self.value(node.name)
+            b, c = self.add_list(node.args)
+        elif kind is CommaNode:
+            b, c = self.add_list(node.items)
+        elif kind is BlockNode:
+            b, c = self.add_list(node.statements)
+        elif kind is AssignNode:
+            a, b = self.value(node.name), self.add(node.value)
+        elif kind is VarNode:
+            b = self.add(node.target)
+        elif kind is ReturnNode or kind is ExprNode:
+            b = self.add(node.value)
+        elif kind is ConditionNode:
+            b, c, d = self.add(node.test), self.add(node.body), self.add(node.orelse)
+        elif kind is WhileNode:
+            b, c = self.add(node.test), self.add(node.body)
+        elif kind is ForNode:
+            a, b, c, d = self.add(node.init), self.add(node.test), self.add(node.increment), self.add(node.body)
+        elif kind is FunctionDefNode:
+            a = self.value(node.name)
+            params = [self.value(param) for param in node.params]
+            b = len(self.children)
+            c = len(params)
+            self.children.extend(params)
+            d = self.add(node.body)
+        index = len(self.kinds)
+        self.kinds.append(NODE_KINDS.index(kind))
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+        self.d.append(d)
+        self.positions.append(-1 if node.position is None else node.position)
+        return index
+    
+    def get_list(self, start, count):
+        return [self.node(index) for index in self.children[start:start+count]]
+    
+    def node(self, index):
+        if index < 0:
+            return None
+        kind = NODE_KINDS[self.kinds[index]]
+        a, b, c, d = self.a[index], self.b[index], self.c[index], self.d[index]
+        position = self.positions[index]
+        position = None if position < 0 else position
+        if kind is NameNode or kind is NumberNode or kind is StringNode or kind is ImportNode:
+            return kind(self.values[a], position=position)
+        elif kind is BinOpNode or kind is CompareNode:
+            return kind(self.values[a], self.node(b), self.node(c), position=position)
+        elif kind is FunctionCallNode:
+            return kind(self.values[a], self.get_list(b, c), position=position)
+        elif kind is CommaNode or kind is BlockNode:
+            return kind(self.get_list(b, c), position=position)
+        elif kind is AssignNode:
+            return kind(self.values[a], self.node(b), position=position)
+        elif kind is VarNode or kind is ReturnNode or kind is ExprNode:
+            return kind(self.node(b), position=position)
+        elif kind is ConditionNode:
+            return kind(self.node(b), self.node(c), self.node(d), position=position)
+        elif kind is WhileNode:
+            return kind(self.node(b), self.node(c), position=position)
+        elif kind is ForNode:
+            return kind(self.node(a), self.node(b), self.node(c), self.node(d), position=position)
+        elif kind is FunctionDefNode:
+            params = [self.values[value] for value in self.children[b:b+c]]
+            return kind(self.values[a], params, self.node(d), position=position)
+    
+    def to_nodes(self, roots):
+        return self.get_list(*roots)
+
+def count_nodes(ast):
+    # an unparsed lazy body counts as one block, so counting never parses it
+    count = 0
+    stack = nodes_from_tuples([node[:3] + (('BLOCK', []),)
+                               if node[0] == 'FUNCTION_DEF' and type(node[3]) is LazyBody and not node[3].resolved
+                               else node for node in ast])
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Node):
+            count += 1
+            for field in node.fields:
+                value = getattr(node, field)
+                if isinstance(value, Node):
+                    stack.append(value)
+                elif type(value) is list:
+                    stack.extend(value)
+    return count
+
+class ASTOptimizer:
+    PASSES = ('literals', 'fold', 'branches', 'functions')
+    
+    def __init__(self, passes=None, builtins=None) -> None:
+        self.passes = set(self.PASSES if passes is None else passes)
+        self.builtins = builtins
+        unknown = self.passes - set(self.PASSES)
+        if unknown:
+            message = f'Unknown optimizer passes {sorted(unknown)}'
+            raise RuntimeError(message)
+        self.report = {}
+
+    def optimize(self, ast):
+        self.stats = {'literals': 0, 'folded': 0, 'branches': 0, 'functions': 0}
+        self.removed_functions = set()
+        if 'functions' in self.passes:
+            # only drop a name when every definition of it is empty; a builtin of the
+            # same name still answers calls made before the definition runs
+            bodies = {}
+            for node in ast:
+                if node[0] == 'FUNCTION_DEF':
+                    bodies.setdefault(node[1], []).append(node[3])
+            builtins = self.builtins.builtins if self.builtins is not None else {}
+            self.removed_functions = {name for name, defs in bodies.items()
+                                      if all(self.empty(body) for body in defs) and name not in builtins}
+        result = self.optimize_statements(ast)
+        self.report = dict(self.stats, nodes_before=count_nodes(ast), nodes_after=count_nodes(result))
+        return result
+
+    def optimize_statements(self, statements):
+        result = []
+        for statement in statements:
+            result.extend(self.optimize_statement(statement))
+            if 'branches' in self.passes and result and result[-1][0] == 'RETURN':
+                if len(result) < len(statements):
+                    self.stats['branches'] += 1
+                break
+        return result
+
+    def optimize_block(self, block):
+        return ('BLOCK', self.optimize_statements(block[1]))
+
+    def empty(self, body):
+        if type(body) is LazyBody:
+            return body.empty
+        return not body[1]
+
+    def argument_effects(self, args):
+        # arguments of a removed call still run: they may call functions or fail
+        effects = []
+        for arg in flatten_arguments(args):
+            arg = self.optimize_expression(arg)
+            expr = strip_position(arg)
+            if type(expr) is str or type(expr) is int or type(expr) is float or type(expr) is bool:
+                continue
+            if type(expr) is tuple and expr and expr[0] == 'STRING':
+                continue
+            effects.append(arg)
+        return effects
+
+    def optimize_statement(self, node):
         node_type = node[0]
         if node_type == 'ASSIGN':
             _, var_name, var_value = node
-            self.variables[var_name] = var_value
-        elif node_type == 'EXPR':
-            return self.evaluate_expression(node[1])
-        elif node_type == 'IF':
-            _, condition, body = node
-            if self.evaluate_expression(condition):
-                self.execute_node(body)
+            return [('ASSIGN', var_name, self.optimize_expression(var_value))]
+        elif node_type == 'VAR':
+            return [('VAR', inner) for inner in self.optimize_statement(node[1])]
+        elif node_type == 'BLOCK':
+            return [self.optimize_block(node)]
+        elif node_type == 'CONDITION':
+            _, condition, body_if, body_else = node
+            condition = self.optimize_expression(condition)
+            body_if = self.optimize_block(body_if)
+            body_else = None if body_else is None else self.optimize_block(body_else)
+            constant, value = self.literal(condition)
+            if 'branches' in self.passes and constant:
+                self.stats['branches'] += 1
+                if value:
+                    return body_if[1]
+                return [] if body_else is None else body_else[1]
+            return [('CONDITION', condition, body_if, body_else)]
         elif node_type == 'WHILE':
             _, condition, body = node
-            while self.evaluate_expression(condition):
-                self.execute_node(body)
+            condition = self.optimize_expression(condition)
+            constant, value = self.literal(condition)
+            if 'branches' in self.passes and constant and not value:
+                self.stats['branches'] += 1
+                return []
+            return [('WHILE', condition, self.optimize_block(body))]
         elif node_type == 'FOR':
             _, init, condition, increment, body = node
-            self.execute_node(init)
-            while self.evaluate_expression(condition):
-                self.execute_node(body)
-                self.execute_node(increment)
-        elif node_type == 'PRINT':
-            _, value = node
-            print(self.evaluate_expression(value))
+            init = self.optimize_statement(init)
+            condition = self.optimize_expression(condition)
+            constant, value = self.literal(condition)
+            if 'branches' in self.passes and constant and not value:
+                self.stats['branches'] += 1
+                return init
+            increment = self.optimize_statement(increment)[0]
+            return [('FOR', init[0], condition, increment, self.optimize_block(body))]
         elif node_type == 'FUNCTION_DEF':
             _, func_name, params, body = node
-            self.functions[func_name] = (params, body)
+            if func_name in self.removed_functions:
+                self.stats['functions'] += 1
+                return []
+            if type(body) is LazyBody and not body.resolved:
+                # optimizing must not parse bodies that were left for their first call
+                return [node]
+            return [('FUNCTION_DEF', func_name, params, self.optimize_block(body))]
         elif node_type == 'FUNCTION_CALL':
-            _, func_name, args = node
-            self.call_function(func_name, args)
-        elif node_type == 'RETURN':
-            value = self.evaluate_expression(node[1])
-            return ('RETURN', value)
+            if node[1] in self.removed_functions:
+                return [('EXPR', effect) for effect in self.argument_effects(node[2])]
+            return [self.optimize_expression(node)]
+        elif node_type == 'RETURN' or node_type == 'EXPR' or node_type == 'PRINT':
+            return [(node_type, self.optimize_expression(node[1]))]
+        elif node_type == 'IMPORT':
+            return [node]
+        return [self.optimize_expression(node)]
 
-    def evaluate_expression(self, expr):
-        if isinstance(expr, (int, float)):
+    def literal(self, expr):
+        expr = strip_position(expr)
+        if type(expr) is bool or type(expr) is int or type(expr) is float:
+            return True, expr
+        if type(expr) is str and expr[:1].isdigit():
+            return True, parse_number(expr)
+        if type(expr) is tuple and expr[0] == 'STRING':
+            return True, expr[1][1:-1]
+        return False, None
+
+    def constant(self, value):
+        if type(value) is str:
+            return ('STRING', f'"{value}"')
+        return value
+
+    def optimize_expression(self, expr):
+        if type(expr) is tuple and len(expr) == 2 and type(expr[1]) is int:
+            return (self.optimize_expression(expr[0]), expr[1])
+        if type(expr) is str:
+            if 'literals' in self.passes and expr[:1].isdigit():
+                self.stats['literals'] += 1
+                return parse_number(expr)
             return expr
-        elif isinstance(expr, str):
-            return self.variables.get(expr, 0)
-        elif isinstance(expr, tuple):
-            if len(expr)==3:
-                op, left, right = expr
-                left_val = self.evaluate_expression(left)
-                right_val = self.evaluate_expression(right)
-                if op == '+':
-                    return left_val + right_val
-                elif op == '-':
-                    return left_val - right_val
-                elif op == '*':
-                    return left_val * right_val
-                elif op == '/':
-                    return left_val / right_val
+        if type(expr) is not tuple:
+            return expr
+        tag = expr[0]
+        if tag == 'FUNCTION_CALL':
+            if expr[1] in self.removed_functions:
+                effects = self.argument_effects(expr[2])
+                if effects:
+                    return ('COMMA', effects + [None])
+                return None
+            args = [self.optimize_expression(arg) for arg in expr[2]]
+            return ('FUNCTION_CALL', expr[1], args)
+        elif tag == 'COMMA':
+            return ('COMMA', [self.optimize_expression(item) for item in expr[1]])
+        elif tag == 'COMPARE' or (len(expr) == 3 and tag in BINARY_OPERATORS):
+            if tag == 'COMPARE':
+                _, op, left, right = expr
+                function = COMPARE_OPERATORS[op]
             else:
-                return expr
+                op, left, right = expr
+                function = BINARY_OPERATORS[op]
+            left = self.optimize_expression(left)
+            right = self.optimize_expression(right)
+            if 'fold' in self.passes:
+                left_constant, left_value = self.literal(left)
+                right_constant, right_value = self.literal(right)
+                if left_constant and right_constant:
+                    try:
+                        value = function(left_value, right_value)
+                    except (ArithmeticError, TypeError):
+                        value = None
+                    if value is not None and not (type(value) is str and '"' in value):
+                        self.stats['folded'] += 1
+                        return self.constant(value)
+            if tag == 'COMPARE':
+                return ('COMPARE', op, left, right)
+            return (op, left, right)
+        return expr
 
-    def call_function(self, func_name, args):
-        if func_name in self.functions:
-            params, body = self.functions[func_name]
-            local_vars = self.variables.copy()
-            for param, arg in zip(params, args):
-                local_vars[param] = self.evaluate_expression(arg)
-            executor = GScriptExecutor(body)
-            executor.variables = local_vars
-            executor.functions = self.functions
-            executor.execute()
\ No newline at end of file
+class ProgramCache:
+    # parsed programs keyed by source hash and plugin list: an LRU in memory bounded by
+    # the marshalled size of its entries, backed by an optional directory of .gsc files.
+    # Entries are kept marshalled, so every parse returns an AST the caller may mutate
+    MAGIC = b'GSPC'
+    VERSION = 1
+    
+    def __init__(self, plugins, directory=None, max_bytes=64 * 1024 * 1024, optimizer=None, builtins=None) -> None:
+        self.plugins = list(plugins)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.optimizer = optimizer
+        if builtins is None and optimizer is not None:
+            builtins = optimizer.builtins
+        self.builtins = builtins
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # marshal's format can change between Python versions
+        signature = [f'marshal:{marshal.version}', 'python:{}.{}'.format(*sys.version_info[:2])]
+        signature += [f'{plugin.__module__}.{plugin.__qualname__}' for plugin in self.plugins]
+        if optimizer is not None:
+            signature.append('optimizer:' + ','.join(sorted(optimizer.passes)))
+        if builtins is not None:
+            signature.append('builtins:' + ','.join(sorted(builtins.builtins)))
+        self.signature = '\n'.join(signature).encode()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+    
+    def key(self, code):
+        digest = hashlib.sha256()
+        digest.update(self.VERSION.to_bytes(2, 'little'))
+        digest.update(self.signature)
+        digest.update(b'\0')
+        digest.update(code.encode())
+        return digest.digest()
+    
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+        }
+    
+    def parse(self, code):
+        key = self.key(code)
+        payload = self.entries.get(key)
+        if payload is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return marshal.loads(payload)
+        
+        ast = self.load(key)
+        if ast is not None:
+            self.disk_hits += 1
+            self.remember(key, marshal.dumps(ast))
+            return ast
+        
+        self.misses += 1
+        parser = GScriptParser(code, builtins=self.builtins)
+        for plugin in self.plugins:
+            parser.register_plugin(plugin)
+        ast = parser.parse()
+        if self.optimizer is not None:
+            ast = self.optimizer.optimize(ast)
+        payload = marshal.dumps(ast)
+        self.store(key, payload)
+        self.remember(key, payload)
+        return ast
+    
+    def remember(self, key, payload):
+        self.entries[key] = payload
+        self.bytes += len(payload)
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+    
+    def path(self, key):
+        return os.path.join(self.directory, key.hex() + '.gsc')
+    
+    def store(self, key, payload):
+        if self.directory is None:
+            return
+        path = self.path(key)
+        temporary = f'{path}.{os.getpid()}.tmp'
+        # a cache that cannot be written (read-only directory, full disk) only costs speed
+        try:
+            with open(temporary, 'wb') as file:
+                file.write(self.MAGIC + self.VERSION.to_bytes(2, 'little') + key + payload)
+            os.replace(temporary, path)
+        except OSError:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+    
+    def load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(key), 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        header = self.MAGIC + self.VERSION.to_bytes(2, 'little') + key
+        if not data.startswith(header):
+            return None
+        try:
+            return marshal.loads(data[len(header):])
+        except (EOFError, ValueError, TypeError):
+            return None
+    
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+class Builtin:
+    __slots__ = ('name', 'function', 'min_args', 'max_args', 'pure', 'calls')
+    
+    def __init__(self, name, function, min_args, max_args, pure=False) -> None:
+        self.name = name
+        self.function = function
+        self.min_args = min_args
+        self.max_args = max_args
+        self.pure = pure
+        self.calls = 0
+
+class BuiltinRegistry:
+    # Python callables that scripts can call by name; a script function of the same name
+    # shadows the builtin. max_args None means any number of arguments
+    def __init__(self) -> None:
+        self.builtins = {}
+    
+    def register(self, name, function, min_args=None, max_args=None, pure=False):
+        if min_args is None:
+            params = inspect.signature(function).parameters.values()
+            positional = [param for param in params if param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD)]
+            min_args = sum(1 for param in positional if param.default is param.empty)
+            if any(param.kind == param.VAR_POSITIONAL for param in params):
+                max_args = None
+            else:
+                max_args = len(positional)
+        self.builtins[name] = Builtin(name, function, min_args, max_args, pure)
+        return function
+    
+    def __contains__(self, name):
+        return name in self.builtins
+    
+    def get(self, name):
+        return self.builtins.get(name)
+    
+    def call(self, name, values):
+        builtin = self.builtins[name]
+        if len(values) < builtin.min_args or (builtin.max_args is not None and len(values) > builtin.max_args):
+            expected = builtin.min_args if builtin.min_args == builtin.max_args else f'{builtin.min_args} to {builtin.max_args}'
+            if builtin.max_args is None:
+                expected = f'at least {builtin.min_args}'
+            message = f'{name}() takes {expected} arguments, got {len(values)}'
+            raise RuntimeError(message)
+        builtin.calls += 1
+        return builtin.function(*values)
+    
+    def stats(self):
+        return {name: builtin.calls for name, builtin in self.builtins.items()}
+
+def builtin_substr(text, start, length=None):
+    return text[start:] if length is None else text[start:start + length]
+
+def builtin_concat(*values):
+    return ''.join(str(value) for value in values)
+
+def standard_builtins():
+    # module-level callables only, so the registry pickles into pool workers
+    registry = BuiltinRegistry()
+    registry.register('abs', abs, 1, 1, pure=True)
+    registry.register('min', min, 1, None, pure=True)
+    registry.register('max', max, 1, None, pure=True)
+    registry.register('round', round, 1, 2, pure=True)
+    registry.register('floor', math.floor, 1, 1, pure=True)
+    registry.register('ceil', math.ceil, 1, 1, pure=True)
+    registry.register('sqrt', math.sqrt, 1, 1, pure=True)
+    registry.register('pow', pow, 2, 2, pure=True)
+    registry.register('len', len, 1, 1, pure=True)
+    registry.register('upper', str.upper, 1, 1, pure=True)
+    registry.register('lower', str.lower, 1, 1, pure=True)
+    registry.register('substr', builtin_substr, pure=True)
+    registry.register('concat', builtin_concat, pure=True)
+    registry.register('str', str, 1, 1, pure=True)
+    registry.register('int', int, 1, 1, pure=True)
+    registry.register('float', float, 1, 1, pure=True)
+    registry.register('print', print, 0, None)
+    return registry
+
+class FunctionScope:
+    # slot layout of a function: parameters, names taken from the caller, then locals
+    def __init__(self, name, params, free, local_names) -> None:
+        self.name = name
+        self.params = list(params)
+        self.free = list(free)
+        self.names = self.params + self.free + list(local_names)
+        self.slots = {name: index for index, name in enumerate(self.names)}
+        self.size = len(self.names)
+        self.bodies = set()
+
+class Frame:
+    __slots__ = ('slots', 'values')
+    
+    def __init__(self, scope) -> None:
+        self.slots = scope.slots
+        self.values = [0] * scope.size
+
+class ScopeResolver:
+    def resolve(self, ast, modules=()):
+        self.prepare(ast, modules)
+        return {func_name: self.scope(func_name) for func_name in self.definitions}
+
+    def prepare(self, ast, modules=()):
+        self.signatures = {}
+        self.conflicts = set()
+        self.definitions = {}
+        self.usage = {}
+        self.scopes = {}
+        for node in ast:
+            if node[0] == 'FUNCTION_DEF':
+                _, func_name, params, body = node
+                if func_name in self.signatures and self.signatures[func_name] != list(params):
+                    self.conflicts.add(func_name)
+                else:
+                    self.signatures[func_name] = list(params)
+                self.definitions.setdefault(func_name, []).append(node)
+        # scopes of imported functions, so that calls to them pass the names they read
+        self.imported = {}
+        for module in modules:
+            for func_name, (params, _) in module.functions.items():
+                if func_name not in self.imported:
+                    self.imported[func_name] = module.resolver.scope(func_name)
+                    self.signatures.setdefault(func_name, list(params))
+
+    def usage_of(self, func_name):
+        usage = self.usage.get(func_name)
+        if usage is None:
+            reads, writes, calls = set(), set(), set()
+            for node in self.definitions[func_name]:
+                self.collect_names(('BLOCK', node[3][1]), reads, writes, calls, True)
+            usage = self.usage[func_name] = (reads, writes, calls)
+        return usage
+
+    def scope(self, func_name):
+        # resolves func_name and whatever it can reach, leaving other bodies untouched
+        if func_name in self.scopes or func_name not in self.definitions:
+            return self.scopes.get(func_name)
+        pending = []
+        stack = [func_name]
+        while stack:
+            name = stack.pop()
+            if name in self.scopes or name in pending or name not in self.definitions:
+                continue
+            pending.append(name)
+            stack.extend(self.usage_of(name)[2])
+        
+        # names a function needs from its caller: everything it reads that is not a
+        # parameter, plus whatever its callees need, so call-by-copy costs O(names used)
+        free = {name: set() for name in pending}
+        changed = True
+        while changed:
+            changed = False
+            for name in pending:
+                reads, writes, calls = self.usage_of(name)
+                needed = set(reads)
+                for callee in calls:
+                    if callee in self.scopes:
+                        needed.update(self.scopes[callee].free)
+                    else:
+                        needed |= free.get(callee, set())
+                    if callee in self.imported:
+                        # the imported function answers the call until the script defines its own
+                        needed.update(self.imported[callee].free)
+                needed -= set(self.signatures[name])
+                if needed != free[name]:
+                    free[name] = needed
+                    changed = True
+        
+        for name in pending:
+            params = self.signatures[name]
+            local_names = sorted(self.usage_of(name)[1] - free[name] - set(params))
+            scope = self.scopes[name] = FunctionScope(name, params, sorted(free[name]), local_names)
+            for node in self.definitions[name]:
+                scope.bodies.add(id(node[3]))
+        return self.scopes[func_name]
+
+    def collect_names(self, node, reads, writes, calls, in_function):
+        if type(node) is str:
+            if node.isalpha():
+                reads.add(node)
+        elif type(node) is tuple and node:
+            if len(node) == 2 and type(node[1]) is int:
+                self.collect_names(node[0], reads, writes, calls, in_function)
+                return
+            tag = node[0]
+            if tag == 'ASSIGN':
+                writes.add(node[1])
+                self.collect_names(node[2], reads, writes, calls, in_function)
+            elif tag == 'FUNCTION_DEF':
+                if in_function:
+                    message = f'Cannot resolve nested function {node[1]}'
+                    raise RuntimeError(message)
+            elif tag == 'FUNCTION_CALL':
+                _, func_name, args = node
+                args = flatten_arguments(args)
+                if func_name in self.signatures:
+                    calls.add(func_name)
+                    params = self.signatures[func_name]
+                    for arg in args[:len(params)]:
+                        self.collect_names(arg, reads, writes, calls, in_function)
+                    # parameters without an argument keep the caller's value
+                    reads.update(params[len(args):])
+                else:
+                    for arg in args:
+                        self.collect_names(arg, reads, writes, calls, in_function)
+            elif tag == 'STRING' or tag == 'IMPORT':
+                return
+            elif tag in ('BLOCK', 'COMMA'):
+                for item in node[1]:
+                    self.collect_names(item, reads, writes, calls, in_function)
+            else:
+                start = 2 if tag == 'COMPARE' else 1
+                for item in node[start:]:
+                    if type(item) is list:
+                        for child in item:
+                            self.collect_names(child, reads, writes, calls, in_function)
+                    else:
+                        self.collect_names(item, reads, writes, calls, in_function)
+
+
+def freeze(node):
+    # lists become tuples and lazy bodies are resolved; a frozen list never reads as an
+    # (expr, position) pair because list items are always tuples or names
+    if type(node) is list or type(node) is tuple:
+        return tuple(freeze(item) for item in node)
+    elif type(node) is LazyBody:
+        return freeze(node.resolve())
+    return node
+
+class BudgetExceeded(RuntimeError):
+    def __init__(self, kind, limit, usage) -> None:
+        self.kind = kind
+        self.limit = limit
+        self.usage = usage
+        super().__init__(f'{kind} budget of {limit} exceeded')
+
+class Meter:
+    # counts evaluated nodes and function calls of an executor and enforces optional
+    # step, wall-clock and call-depth limits. install shadows the executor's hot methods
+    # on the instance, so an executor without a meter runs the plain class methods.
+    # Every install and every execute() of the installed executor starts a fresh budget;
+    # executors created for nested calls are installed with root=False and share it
+    def __init__(self, max_steps=None, max_seconds=None, max_depth=None, check_every=1024) -> None:
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self.check_every = check_every
+        self.reset()
+    
+    def reset(self):
+        self.counted = 0
+        self.period = 0
+        self.countdown = 0
+        self.calls = 0
+        self.depth = 0
+        self.max_depth_seen = 0
+        self.started = time.perf_counter()
+        self.deadline = None
+        if self.max_seconds is not None:
+            self.deadline = self.started + self.max_seconds
+    
+    def install(self, executor, root=True):
+        if getattr(executor, 'compiled_depth', 0):
+            # a compiled loop never returns to the methods a meter wraps
+            message = 'Cannot install a meter while the executor runs a compiled loop'
+            raise RuntimeError(message)
+        executor.meter = self
+        if root:
+            self.reset()
+            execute = executor.execute
+            if inspect.iscoroutinefunction(execute):
+                async def metered_execute():
+                    self.reset()
+                    return await execute()
+            else:
+                def metered_execute():
+                    self.reset()
+                    return execute()
+            executor.execute = metered_execute
+        if isinstance(executor, AsyncExecutor):
+            self.install_async(executor)
+        execute_node = executor.execute_node
+        evaluate_expression = executor.evaluate_expression
+        call_function = executor.call_function
+        # steps are counted down to the next check so the common case is one decrement
+        def metered_execute_node(node):
+            self.countdown -= 1
+            if self.countdown <= 0:
+                self.check()
+            return execute_node(node)
+        
+        def metered_evaluate_expression(expr):
+            self.countdown -= 1
+            if self.countdown <= 0:
+                self.check()
+            return evaluate_expression(expr)
+        
+        def metered_call_function(func_name, args):
+            self.calls += 1
+            self.depth += 1
+            if self.depth > self.max_depth_seen:
+                self.max_depth_seen = self.depth
+            if self.max_depth is not None and self.depth > self.max_depth:
+                self.depth -= 1
+                raise BudgetExceeded('depth', self.max_depth, self.usage())
+            try:
+                return call_function(func_name, args)
+            finally:
+                self.depth -= 1
+        
+        executor.execute_node = metered_execute_node
+        executor.evaluate_expression = metered_evaluate_expression
+        executor.call_function = metered_call_function
+        return executor
+    
+    def install_async(self, executor):
+        execute_node_async = executor.execute_node_async
+        evaluate_async = executor.evaluate_async
+        call_async = executor.call_async
+        
+        async def metered_execute_node_async(node):
+            self.countdown -= 1
+            if self.countdown <= 0:
+                self.check()
+            return await execute_node_async(node)
+        
+        async def metered_evaluate_async(expr):
+            self.countdown -= 1
+            if self.countdown <= 0:
+                self.check()
+            return await evaluate_async(expr)
+        
+        async def metered_call_async(func_name, args):
+            self.calls += 1
+            self.depth += 1
+            if self.depth > self.max_depth_seen:
+                self.max_depth_seen = self.depth
+            if self.max_depth is not None and self.depth > self.max_depth:
+                self.depth -= 1
+                raise BudgetExceeded('depth', self.max_depth, self.usage())
+            try:
+                return await call_async(func_name, args)
+            finally:
+                self.depth -= 1
+        
+        executor.execute_node_async = metered_execute_node_async
+        executor.evaluate_async = metered_evaluate_async
+        executor.call_async = metered_call_async
+    
+    def uninstall(self, executor):
+        for name in ('execute', 'execute_node', 'evaluate_expression', 'call_function',
+                     'execute_node_async', 'evaluate_async', 'call_async'):
+            executor.__dict__.pop(name, None)
+        executor.meter = None
+    
+    def check(self):
+        self.counted += self.period - self.countdown
+        self.period = self.countdown = 0
+        if self.max_steps is not None and self.counted > self.max_steps:
+            raise BudgetExceeded('steps', self.max_steps, self.usage())
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise BudgetExceeded('seconds', self.max_seconds, self.usage())
+        self.period = self.check_every
+        if self.max_steps is not None:
+            self.period = max(1, min(self.period, self.max_steps + 1 - self.counted))
+        self.countdown = self.period
+    
+    @property
+    def steps(self):
+        return self.counted + self.period - self.countdown
+    
+    def usage(self):
+        return {
+            'steps': self.steps,
+            'calls': self.calls,
+            'max_depth': self.max_depth_seen,
+            'seconds': 0.0 if self.started is None else time.perf_counter() - self.started,
+        }
+
+class Profiler:
+    # per-function call counts with inclusive/exclusive time and per-node hit counts.
+    # Like Meter it wraps methods on one executor instance, so unprofiled runs are untouched
+    ROOT = '<program>'
+    
+    def __init__(self, spans=None, clock=time.perf_counter) -> None:
+        self.spans = spans
+        self.clock = clock
+        self.functions = {}
+        self.node_hits = {}
+        self.stacks = {}
+        self.stack = []
+        self.active = {}
+    
+    def install(self, executor, root=True):
+        executor.profiler = self
+        execute = executor.execute
+        execute_node = executor.execute_node
+        evaluate_expression = executor.evaluate_expression
+        call_function = executor.call_function
+        node_hits = self.node_hits
+        
+        def profiled_execute_node(node):
+            entry = node_hits.get(id(node))
+            if entry is None:
+                node_hits[id(node)] = [node, 1]
+            else:
+                entry[1] += 1
+            return execute_node(node)
+        
+        def profiled_evaluate_expression(expr):
+            if type(expr) is tuple and not (len(expr) == 2 and type(expr[1]) is int):
+                entry = node_hits.get(id(expr))
+                if entry is None:
+                    node_hits[id(expr)] = [expr, 1]
+                else:
+                    entry[1] += 1
+            return evaluate_expression(expr)
+        
+        def profiled_call_function(func_name, args):
+            self.enter(func_name)
+            try:
+                return call_function(func_name, args)
+            finally:
+                self.leave()
+        
+        def profiled_execute():
+            self.enter(self.ROOT)
+            try:
+                return execute()
+            finally:
+                self.leave()
+        
+        if root:
+            executor.execute = profiled_execute
+        executor.execute_node = profiled_execute_node
+        executor.evaluate_expression = profiled_evaluate_expression
+        executor.call_function = profiled_call_function
+        return executor
+    
+    def enter(self, func_name):
+        # frames are [name, start, time spent in callees]
+        self.stack.append([func_name, self.clock(), 0.0])
+        self.active[func_name] = self.active.get(func_name, 0) + 1
+    
+    def leave(self):
+        func_name, start, children = self.stack.pop()
+        elapsed = self.clock() - start
+        self.active[func_name] -= 1
+        entry = self.functions.get(func_name)
+        if entry is None:
+            entry = self.functions[func_name] = [0, 0.0, 0.0]
+        entry[0] += 1
+        # recursive calls only add to inclusive time at the outermost frame
+        if not self.active[func_name]:
+            entry[1] += elapsed
+        entry[2] += elapsed - children
+        path = ';'.join([frame[0] for frame in self.stack] + [func_name])
+        self.stacks[path] = self.stacks.get(path, 0.0) + elapsed - children
+        if self.stack:
+            self.stack[-1][2] += elapsed
+    
+    def location(self, node):
+        position = first_position(node)
+        if position is None:
+            return '?'
+        if self.spans is None:
+            return f'token {position}'
+        line, column = self.spans.line_column(position)
+        return f'{line}:{column}'
+    
+    def collapsed(self):
+        # one "frame;frame;frame microseconds" line per stack, as flamegraph.pl reads them
+        return '\n'.join(f'{path} {round(seconds * 1e6)}' for path, seconds in sorted(self.stacks.items()))
+    
+    def report(self, limit=20):
+        lines = [f'{"function":<24}{"calls":>10}{"inclusive":>14}{"exclusive":>14}']
+        ordered = sorted(self.functions.items(), key=lambda item: item[1][2], reverse=True)
+        for func_name, (calls, inclusive, exclusive) in ordered[:limit]:
+            lines.append(f'{func_name:<24}{calls:>10}{inclusive * 1000:>12.3f}ms{exclusive * 1000:>12.3f}ms')
+        lines.append('')
+        lines.append(f'{"node":<24}{"hits":>10}  location')
+        hits = sorted(self.node_hits.values(), key=lambda entry: entry[1], reverse=True)
+        for node, count in hits[:limit]:
+            node_type = strip_position(node)
+            label = node_type[0] if type(node_type) is tuple else repr(node_type)
+            lines.append(f'{label:<24}{count:>10}  {self.location(node)}')
+        return '\n'.join(lines)
+
+class PurityError(RuntimeError):
+    pass
+
+class PurityAnalysis:
+    # a function is pure when every name it reads is a parameter or was definitely
+    # assigned before the read, and it only calls pure functions or pure builtins.
+    # Functions never write the caller's variables, so reads are all that can leak in
+    def __init__(self, ast, builtins=None) -> None:
+        self.builtins = builtins
+        self.definitions = {}
+        for node in ast:
+            if node[0] == 'FUNCTION_DEF':
+                self.definitions.setdefault(node[1], []).append(node)
+        self.reasons = {}
+        self.pure = set(self.definitions)
+        changed = True
+        while changed:
+            changed = False
+            for func_name in sorted(self.pure):
+                reason = self.check_function(func_name)
+                if reason is not None:
+                    self.pure.discard(func_name)
+                    self.reasons[func_name] = reason
+                    changed = True
+    
+    def check_function(self, func_name):
+        definitions = self.definitions[func_name]
+        if len({tuple(node[2]) for node in definitions}) > 1:
+            return 'conflicting definitions'
+        for node in definitions:
+            try:
+                self.check_statements(node[3][1], set(node[2]))
+            except PurityError as error:
+                return str(error)
+        return None
+    
+    def check_statements(self, statements, assigned):
+        for statement in statements:
+            assigned = self.check_statement(statement, assigned)
+        return assigned
+    
+    def check_statement(self, node, assigned):
+        node_type = node[0] if type(node) is tuple else None
+        if node_type == 'ASSIGN':
+            self.check_expression(node[2], assigned)
+            return assigned | {node[1]}
+        elif node_type == 'VAR':
+            return self.check_statement(node[1], assigned)
+        elif node_type == 'BLOCK':
+            return self.check_statements(node[1], assigned)
+        elif node_type == 'CONDITION':
+            _, condition, body_if, body_else = node
+            self.check_expression(condition, assigned)
+            after_if = self.check_statement(body_if, assigned)
+            after_else = assigned if body_else is None else self.check_statement(body_else, assigned)
+            return after_if & after_else
+        elif node_type == 'IF':
+            self.check_expression(node[1], assigned)
+            self.check_statement(node[2], assigned)
+            return assigned
+        elif node_type == 'WHILE':
+            self.check_expression(node[1], assigned)
+            self.check_statement(node[2], assigned)
+            return assigned
+        elif node_type == 'FOR':
+            _, init, condition, increment, body = node
+            assigned = self.check_statement(init, assigned)
+            self.check_expression(condition, assigned)
+            self.check_statement(increment, self.check_statement(body, assigned))
+            return assigned
+        elif node_type in ('RETURN', 'EXPR'):
+            self.check_expression(node[1], assigned)
+            return assigned
+        elif node_type == 'PRINT':
+            raise PurityError('prints')
+        elif node_type == 'FUNCTION_DEF':
+            raise PurityError(f'defines {node[1]}')
+        self.check_expression(node, assigned)
+        return assigned
+    
+    def check_expression(self, expr, assigned):
+        expr = strip_position(expr)
+        if type(expr) is str:
+            if expr.isalpha() and expr not in assigned:
+                raise PurityError(f'reads {expr} from its caller')
+        elif type(expr) is tuple and expr:
+            tag = expr[0]
+            if tag == 'FUNCTION_CALL':
+                _, func_name, args = expr
+                args = flatten_arguments(args)
+                for arg in args:
+                    self.check_expression(arg, assigned)
+                builtin = self.builtins.get(func_name) if self.builtins is not None else None
+                if func_name in self.definitions:
+                    # the builtin still answers calls made before the definition runs
+                    if func_name not in self.pure or (builtin is not None and not builtin.pure):
+                        raise PurityError(f'calls impure {func_name}')
+                    # parameters without an argument are read from this function
+                    for param in self.definitions[func_name][0][2][len(args):]:
+                        self.check_expression(param, assigned)
+                elif builtin is None or not builtin.pure:
+                    raise PurityError(f'calls {func_name}')
+            elif tag == 'STRING':
+                return
+            elif tag == 'COMMA':
+                for item in expr[1]:
+                    self.check_expression(item, assigned)
+            else:
+                for item in expr[2:] if tag == 'COMPARE' else expr[1:]:
+                    self.check_expression(item, assigned)
+
+class FunctionMemo:
+    # LRU result caches for the pure functions of a program, keyed by argument values and
+    # their types so 1 and 1.0 stay apart. install wraps call_function on one executor
+    def __init__(self, ast, max_size=1024, exclude=(), builtins=None) -> None:
+        self.analysis = PurityAnalysis(ast, builtins)
+        self.max_size = max_size
+        self.bodies = {}
+        for func_name in self.analysis.pure:
+            if func_name not in exclude:
+                self.bodies[func_name] = {id(node[3]) for node in self.analysis.definitions[func_name]}
+        self.caches = {func_name: OrderedDict() for func_name in self.bodies}
+        self.hits = dict.fromkeys(self.bodies, 0)
+        self.misses = dict.fromkeys(self.bodies, 0)
+    
+    def disable(self, func_name):
+        self.bodies.pop(func_name, None)
+    
+    def install(self, executor):
+        call_function = executor.call_function
+        evaluate_expression = executor.evaluate_expression
+        lookup = executor.lookup
+        functions = executor.functions
+        
+        def memoized_call_function(func_name, args):
+            bodies = self.bodies.get(func_name)
+            entry = functions.get(func_name)
+            if bodies is None or entry is None or id(entry[1]) not in bodies:
+                return call_function(func_name, args)
+            params = entry[0]
+            args = flatten_arguments(args)
+            values = [evaluate_expression(arg) for arg in args[:len(params)]]
+            values += [lookup(param) for param in params[len(values):]]
+            key = tuple(values) + tuple(map(type, values))
+            cache = self.caches[func_name]
+            if key in cache:
+                cache.move_to_end(key)
+                self.hits[func_name] += 1
+                return cache[key]
+            self.misses[func_name] += 1
+            # the arguments are already evaluated: pass them on as literals
+            literals = [('STRING', f'"{value}"') if type(value) is str else value for value in values]
+            result = call_function(func_name, literals)
+            cache[key] = result
+            if len(cache) > self.max_size:
+                cache.popitem(last=False)
+            return result
+        
+        executor.call_function = memoized_call_function
+        return executor
+    
+    def stats(self):
+        report = {}
+        for func_name in self.caches:
+            calls = self.hits[func_name] + self.misses[func_name]
+            report[func_name] = {
+                'hits': self.hits[func_name],
+                'misses': self.misses[func_name],
+                'hit_rate': self.hits[func_name] / calls if calls else 0.0,
+                'size': len(self.caches[func_name]),
+            }
+        return report
+
+MODULE_TABLE = {}
+MODULE_LOCK = threading.RLock()
+
+class Module:
+    # a parsed library: its function table (its own definitions over those of its imports)
+    # is read-only and shared by every importer in the process
+    __slots__ = ('name', 'path', 'functions', 'definitions', 'resolver', 'imports')
+    
+    def __init__(self, name, path, definitions, imports) -> None:
+        self.name = name
+        self.path = path
+        self.imports = imports
+        functions = {}
+        all_definitions = []
+        for module in imports:
+            functions.update(module.functions)
+            all_definitions.extend(module.definitions)
+        for node in definitions:
+            functions[node[1]] = (node[2], node[3])
+        all_definitions.extend(definitions)
+        self.functions = MappingProxyType(functions)
+        self.definitions = tuple(all_definitions)
+        # bodies are resolved, and lazily parsed, on the first call to each function
+        self.resolver = ScopeResolver()
+        self.resolver.prepare(self.definitions)
+
+class ModuleLoader:
+    # finds "name" as name.gs along the search path. Modules are parsed once per process,
+    # with lazy function bodies, into MODULE_TABLE keyed by real path
+    DEFAULT = None
+    
+    def __init__(self, plugins, path=None) -> None:
+        self.plugins = list(plugins)
+        if ImportParser not in self.plugins:
+            self.plugins.insert(0, ImportParser)
+        if path is None:
+            path = [entry for entry in os.environ.get('GSCRIPT_PATH', '').split(os.pathsep) if entry]
+            path.append(os.getcwd())
+        self.path = list(path)
+        self.loading = []
+        self.loaded = 0
+    
+    @classmethod
+    def default(cls, plugins=None):
+        with MODULE_LOCK:
+            if cls.DEFAULT is None:
+                if plugins is None:
+                    message = 'No module loader: set a ModuleLoader on the parser or executor'
+                    raise RuntimeError(message)
+                cls.DEFAULT = cls(plugins)
+            return cls.DEFAULT
+    
+    def find(self, module_name):
+        filename = module_name if module_name.endswith('.gs') else module_name + '.gs'
+        for directory in self.path:
+            candidate = os.path.join(directory, filename)
+            if os.path.isfile(candidate):
+                return os.path.realpath(candidate)
+        message = f'Module {module_name} not found in {self.path}'
+        raise RuntimeError(message)
+    
+    def load(self, module_name):
+        path = self.find(module_name)
+        module = MODULE_TABLE.get(path)
+        if module is not None:
+            return module
+        with MODULE_LOCK:
+            module = MODULE_TABLE.get(path)
+            if module is not None:
+                return module
+            if path in self.loading:
+                cycle = [os.path.basename(entry) for entry in self.loading[self.loading.index(path):]]
+                message = f'Import cycle: {" -> ".join(cycle + [os.path.basename(path)])}'
+                raise RuntimeError(message)
+            self.loading.append(path)
+            try:
+                module = MODULE_TABLE[path] = self.compile(module_name, path)
+                self.loaded += 1
+            finally:
+                self.loading.pop()
+            return module
+    
+    def compile(self, module_name, path):
+        with open(path) as file:
+            code = file.read()
+        parser = GScriptParser(code, lazy_functions=True)
+        parser.loader = self
+        for plugin in self.plugins:
+            parser.register_plugin(plugin)
+        definitions = []
+        imports = []
+        for node in parser.parse():
+            if node[0] == 'FUNCTION_DEF':
+                definitions.append(node)
+            elif node[0] == 'IMPORT':
+                imports.append(self.load(node[1]))
+            else:
+                message = f'Module {module_name} may only define functions and import modules, got {node[0]}'
+                raise RuntimeError(message)
+        return Module(module_name, path, definitions, imports)
+
+def imported_modules(ast, loader=None):
+    # the modules named by import statements anywhere in ast, in source order
+    modules = []
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if type(node) is tuple and len(node) == 2 and node[0] == 'IMPORT' and type(node[1]) is str:
+            if loader is None:
+                loader = ModuleLoader.default()
+            module = loader.load(node[1])
+            if module not in modules:
+                modules.append(module)
+        elif type(node) is tuple or type(node) is list or type(node) is LazyBody:
+            stack.extend(reversed(list(node)))
+    return modules
+
+class Program:
+    # immutable parse result that threads can share: the AST is frozen, top-level functions
+    # sit in a read-only table and scopes are resolved up front, so each run only needs
+    # its own executor for variables, frames and the run-time function table
+    __slots__ = ('ast', 'functions', 'resolver', 'builtins')
+    
+    def __init__(self, ast, builtins=None) -> None:
+        ast = freeze(ast)
+        functions = {}
+        for node in ast:
+            if node[0] == 'FUNCTION_DEF':
+                functions[node[1]] = (node[2], node[3])
+        resolver = ScopeResolver()
+        resolver.resolve(ast)
+        object.__setattr__(self, 'ast', ast)
+        object.__setattr__(self, 'functions', MappingProxyType(functions))
+        object.__setattr__(self, 'resolver', resolver)
+        object.__setattr__(self, 'builtins', builtins)
+    
+    def __setattr__(self, name, value):
+        message = f'Program is immutable, cannot set {name}'
+        raise RuntimeError(message)
+    
+    def executor(self):
+        executor = GScriptExecutor(self.ast, self.builtins)
+        executor.resolver = self.resolver
+        return executor
+    
+    def run(self, variables=None, meter=None):
+        executor = self.executor()
+        if meter is not None:
+            meter.install(executor)
+        if variables:
+            executor.variables.update(variables)
+        value = executor.execute()
+        return executor.variables, value
+
+class Snapshot:
+    # frozen globals and functions of a warmed-up executor. Each fork layers an empty dict
+    # over them, so reads fall through to the snapshot, writes stay in the fork and forking
+    # costs the same however large the snapshot is
+    __slots__ = ('variables', 'functions', 'definitions', 'resolver', 'builtins', 'loader', 'modules')
+    
+    def __init__(self, executor) -> None:
+        functions = dict(executor.functions)
+        definitions = tuple(('FUNCTION_DEF', func_name, params, body) for func_name, (params, body) in functions.items())
+        resolver = ScopeResolver()
+        resolver.resolve(definitions)
+        object.__setattr__(self, 'variables', MappingProxyType(dict(executor.variables)))
+        object.__setattr__(self, 'functions', MappingProxyType(functions))
+        object.__setattr__(self, 'definitions', definitions)
+        object.__setattr__(self, 'resolver', resolver)
+        object.__setattr__(self, 'builtins', executor.builtins)
+        object.__setattr__(self, 'loader', executor.loader)
+        object.__setattr__(self, 'modules', tuple(executor.modules))
+    
+    def __setattr__(self, name, value):
+        message = f'Snapshot is immutable, cannot set {name}'
+        raise RuntimeError(message)
+    
+    def fork(self, ast=(), variables=None):
+        executor = GScriptExecutor(ast, self.builtins)
+        executor.variables = ChainMap(dict(variables) if variables else {}, self.variables)
+        executor.functions = ChainMap({}, self.functions)
+        executor.loader = self.loader
+        executor.modules = list(self.modules)
+        if any(node[0] == 'FUNCTION_DEF' for node in ast):
+            # functions defined by the request need scopes alongside the snapshot's
+            executor.resolver = ScopeResolver()
+            executor.resolver.prepare(self.definitions + tuple(ast))
+        else:
+            executor.resolver = self.resolver
+        return executor
+    
+    def run(self, ast, variables=None, meter=None):
+        executor = self.fork(ast, variables)
+        if meter is not None:
+            meter.install(executor)
+        value = executor.execute()
+        return executor.variables.maps[0], value
+
+class GScriptExecutor:
+    def __init__(self, ast, builtins=None):
+        self.ast = ast
+        self.builtins = builtins
+        self.variables = {}
+        self.functions = {}
+        self.frame = None
+        self.resolver = None
+        self.frame_pools = {}
+        self.meter = None
+        self.profiler = None
+        self.loader = None
+        self.modules = []
+
+    def execute(self):
+        for node in self.ast:
+            result = self.execute_node(node)
+            if type(result) is tuple:
+                return result[1]
+
+    def snapshot(self):
+        return Snapshot(self)
+
+    def execute_node(self, node):
+        node_type = node[0]
+        if node_type == 'ASSIGN':
+            _, var_name, var_value = node
+            if type(var_value) is str and var_value[:1].isdigit():
+                value = parse_number(var_value)
+            else:
+                value = self.evaluate_expression(var_value)
+            frame = self.frame
+            if frame is not None and var_name in frame.slots:
+                frame.values[frame.slots[var_name]] = value
+            else:
+                self.variables[var_name] = value
+        elif node_type == 'VAR':
+            return self.execute_node(node[1])
+        elif node_type == 'EXPR':
+            return self.evaluate_expression(node[1])
+        elif node_type == 'BLOCK':
+            for statement in node[1]:
+                result = self.execute_node(statement)
+                if type(result) is tuple:
+                    return result
+        elif node_type == 'CONDITION':
+            _, condition, body_if, body_else = node
+            if self.evaluate_expression(condition):
+                return self.execute_node(body_if)
+            elif body_else is not None:
+                return self.execute_node(body_else)
+        elif node_type == 'IF':
+            _, condition, body = node
+            if self.evaluate_expression(condition):
+                return self.execute_node(body)
+        elif node_type == 'WHILE':
+            _, condition, body = node
+            while self.evaluate_expression(condition):
+                result = self.execute_node(body)
+                if type(result) is tuple:
+                    return result
+        elif node_type == 'FOR':
+            _, init, condition, increment, body = node
+            self.execute_node(init)
+            while self.evaluate_expression(condition):
+                result = self.execute_node(body)
+                if type(result) is tuple:
+                    return result
+                self.execute_node(increment)
+        elif node_type == 'PRINT':
+            _, value = node
+            print(self.evaluate_expression(value))
+        elif node_type == 'FUNCTION_DEF':
+            _, func_name, params, body = node
+            self.functions[func_name] = (params, body)
+        elif node_type == 'FUNCTION_CALL':
+            _, func_name, args = node
+            self.call_function(func_name, args)
+        elif node_type == 'RETURN':
+            value = self.evaluate_expression(node[1])
+            return ('RETURN', value)
+        elif node_type == 'IMPORT':
+            loader = self.loader if self.loader is not None else ModuleLoader.default()
+            module = loader.load(node[1])
+            if module not in self.modules:
+                self.modules.append(module)
+        else:
+            # bare expression statement, e.g. an (expr, position) pair
+            self.evaluate_expression(node)
+
+    def evaluate_expression(self, expr):
+        if isinstance(expr, (int, float)):
+            return expr
+        elif isinstance(expr, str):
+            frame = self.frame
+            if frame is not None:
+                slot = frame.slots.get(expr)
+                if slot is not None:
+                    return frame.values[slot]
+            return self.variables.get(expr, 0)
+        elif isinstance(expr, tuple):
+            if len(expr) == 2 and type(expr[1]) is int:
+                return self.evaluate_expression(expr[0])
+            tag = expr[0]
+            if tag == 'FUNCTION_CALL':
+                return self.call_function(expr[1], expr[2])
+            elif tag == 'COMPARE':
+                _, op, left, right = expr
+                return COMPARE_OPERATORS[op](self.evaluate_expression(left), self.evaluate_expression(right))
+            elif tag == 'STRING':
+                return expr[1][1:-1]
+            elif tag == 'COMMA':
+                value = None
+                for item in expr[1]:
+                    value = self.evaluate_expression(item)
+                return value
+            elif len(expr)==3:
+                op, left, right = expr
+                left_val = self.evaluate_expression(left)
+                right_val = self.evaluate_expression(right)
+                if op == '+':
+                    return left_val + right_val
+                elif op == '-':
+                    return left_val - right_val
+                elif op == '*':
+                    return left_val * right_val
+                elif op == '/':
+                    return left_val / right_val
+            else:
+                return expr
+
+    def lookup(self, name):
+        frame = self.frame
+        if frame is not None and name in frame.slots:
+            return frame.values[frame.slots[name]]
+        return self.variables.get(name, 0)
+
+    def call_function(self, func_name, args):
+        if func_name in self.functions:
+            params, body = self.functions[func_name]
+            if self.resolver is None:
+                self.resolver = ScopeResolver()
+                self.resolver.prepare(self.ast)
+            scope = self.resolver.scope(func_name)
+            if scope is None or id(body) not in scope.bodies:
+                return self.call_unresolved(params, body, args)
+            return self.call_scoped(scope, params, body, args)
+        for module in self.modules:
+            # imported functions run in scopes resolved once per module
+            entry = module.functions.get(func_name)
+            if entry is not None:
+                return self.call_scoped(module.resolver.scope(func_name), entry[0], entry[1], args)
+        if self.builtins is not None and func_name in self.builtins.builtins:
+            # builtins need no frame or scope, only the argument values
+            return self.builtins.call(func_name, [self.evaluate_expression(arg) for arg in flatten_arguments(args)])
+
+    def call_scoped(self, scope, params, body, args):
+        args = flatten_arguments(args)
+        values = [self.evaluate_expression(arg) for arg in args[:len(params)]]
+        pool = self.frame_pools.get(scope)
+        if pool is None:
+            pool = self.frame_pools[scope] = []
+        frame = pool.pop() if pool else Frame(scope)
+        slots = frame.values
+        slots[:len(values)] = values
+        for index in range(len(values), len(params)):
+            slots[index] = self.lookup(params[index])
+        for index in range(len(params), len(params) + len(scope.free)):
+            slots[index] = self.lookup(scope.names[index])
+        for index in range(len(params) + len(scope.free), scope.size):
+            slots[index] = 0
+        
+        caller = self.frame
+        self.frame = frame
+        try:
+            for statement in body[1]:
+                result = self.execute_node(statement)
+                if type(result) is tuple:
+                    return result[1]
+        finally:
+            self.frame = caller
+            pool.append(frame)
+
+    def call_unresolved(self, params, body, args):
+        # functions the resolver has not seen run on a copy of the caller's names
+        local_vars = self.variables.copy()
+        if self.frame is not None:
+            for name, index in self.frame.slots.items():
+                local_vars[name] = self.frame.values[index]
+        for param, arg in zip(params, flatten_arguments(args)):
+            local_vars[param] = self.evaluate_expression(arg)
+        executor = GScriptExecutor(body[1], self.builtins)
+        executor.variables = local_vars
+        executor.functions = self.functions
+        executor.loader = self.loader
+        executor.modules = self.modules
+        if self.meter is not None:
+            self.meter.install(executor, root=False)
+        if self.profiler is not None:
+            self.profiler.install(executor, root=False)
+        return executor.execute()
+
+class AsyncExecutor(GScriptExecutor):
+    # GScriptExecutor for asyncio: calls may target host functions, plain or async, and
+    # loops hand control back to the event loop every yield_every iterations. Expressions
+    # without calls go through the inherited synchronous evaluator
+    def __init__(self, ast, hosts=None, yield_every=100, builtins=None):
+        super().__init__(ast, builtins)
+        self.hosts = dict(hosts or {})
+        self.yield_every = yield_every
+        self.steps = 0
+        self.has_call = {}
+
+    async def execute(self):
+        for node in self.ast:
+            result = await self.execute_node_async(node)
+            if type(result) is tuple:
+                return result[1]
+
+    async def tick(self):
+        self.steps += 1
+        if self.steps % self.yield_every == 0:
+            await asyncio.sleep(0)
+
+    async def execute_node_async(self, node):
+        node_type = node[0]
+        if node_type == 'ASSIGN':
+            _, var_name, var_value = node
+            if type(var_value) is str and var_value[:1].isdigit():
+                value = parse_number(var_value)
+            else:
+                value = await self.evaluate_async(var_value)
+            frame = self.frame
+            if frame is not None and var_name in frame.slots:
+                frame.values[frame.slots[var_name]] = value
+            else:
+                self.variables[var_name] = value
+        elif node_type == 'VAR':
+            return await self.execute_node_async(node[1])
+        elif node_type == 'EXPR':
+            return await self.evaluate_async(node[1])
+        elif node_type == 'BLOCK':
+            for statement in node[1]:
+                result = await self.execute_node_async(statement)
+                if type(result) is tuple:
+                    return result
+        elif node_type == 'CONDITION':
+            _, condition, body_if, body_else = node
+            if await self.evaluate_async(condition):
+                return await self.execute_node_async(body_if)
+            elif body_else is not None:
+                return await self.execute_node_async(body_else)
+        elif node_type == 'IF':
+            _, condition, body = node
+            if await self.evaluate_async(condition):
+                return await self.execute_node_async(body)
+        elif node_type == 'WHILE':
+            _, condition, body = node
+            while await self.evaluate_async(condition):
+                result = await self.execute_node_async(body)
+                if type(result) is tuple:
+                    return result
+                await self.tick()
+        elif node_type == 'FOR':
+            _, init, condition, increment, body = node
+            await self.execute_node_async(init)
+            while await self.evaluate_async(condition):
+                result = await self.execute_node_async(body)
+                if type(result) is tuple:
+                    return result
+                await self.execute_node_async(increment)
+                await self.tick()
+        elif node_type == 'PRINT':
+            _, value = node
+            print(await self.evaluate_async(value))
+        elif node_type == 'FUNCTION_DEF':
+            _, func_name, params, body = node
+            self.functions[func_name] = (params, body)
+        elif node_type == 'FUNCTION_CALL':
+            _, func_name, args = node
+            await self.call_async(func_name, args)
+        elif node_type == 'RETURN':
+            value = await self.evaluate_async(node[1])
+            return ('RETURN', value)
+        elif node_type == 'IMPORT':
+            self.execute_node(node)
+        else:
+            await self.evaluate_async(node)
+
+    def contains_call(self, expr):
+        key = id(expr)
+        found = self.has_call.get(key)
+        if found is None:
+            found = False
+            stack = [expr]
+            while stack:
+                item = stack.pop()
+                if type(item) is tuple or type(item) is list:
+                    if item and item[0] == 'FUNCTION_CALL':
+                        found = True
+                        break
+                    stack.extend(item)
+            self.has_call[key] = found
+        return found
+
+    async def evaluate_async(self, expr):
+        if not self.contains_call(expr):
+            return self.evaluate_expression(expr)
+        expr = strip_position(expr)
+        tag = expr[0]
+        if tag == 'FUNCTION_CALL':
+            return await self.call_async(expr[1], expr[2])
+        elif tag == 'COMPARE':
+            _, op, left, right = expr
+            return COMPARE_OPERATORS[op](await self.evaluate_async(left), await self.evaluate_async(right))
+        elif tag == 'COMMA':
+            value = None
+            for item in expr[1]:
+                value = await self.evaluate_async(item)
+            return value
+        op, left, right = expr
+        return BINARY_OPERATORS[op](await self.evaluate_async(left), await self.evaluate_async(right))
+
+    async def call_async(self, func_name, args):
+        if func_name not in self.functions:
+            for module in self.modules:
+                entry = module.functions.get(func_name)
+                if entry is not None:
+                    return await self.call_scoped_async(module.resolver.scope(func_name), entry[0], entry[1], args)
+            host = self.hosts.get(func_name)
+            if host is None:
+                if self.builtins is not None and func_name in self.builtins.builtins:
+                    values = [await self.evaluate_async(arg) for arg in flatten_arguments(args)]
+                    return self.builtins.call(func_name, values)
+                return None
+            values = [await self.evaluate_async(arg) for arg in flatten_arguments(args)]
+            result = host(*values)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        
+        params, body = self.functions[func_name]
+        if self.resolver is None:
+            self.resolver = ScopeResolver()
+            self.resolver.prepare(self.ast)
+        scope = self.resolver.scope(func_name)
+        if scope is None or id(body) not in scope.bodies:
+            return await self.call_unresolved_async(params, body, args)
+        return await self.call_scoped_async(scope, params, body, args)
+
+    async def call_scoped_async(self, scope, params, body, args):
+        args = flatten_arguments(args)
+        values = [await self.evaluate_async(arg) for arg in args[:len(params)]]
+        pool = self.frame_pools.get(scope)
+        if pool is None:
+            pool = self.frame_pools[scope] = []
+        frame = pool.pop() if pool else Frame(scope)
+        slots = frame.values
+        slots[:len(values)] = values
+        for index in range(len(values), len(params)):
+            slots[index] = self.lookup(params[index])
+        for index in range(len(params), len(params) + len(scope.free)):
+            slots[index] = self.lookup(scope.names[index])
+        for index in range(len(params) + len(scope.free), scope.size):
+            slots[index] = 0
+        
+        caller = self.frame
+        self.frame = frame
+        try:
+            for statement in body[1]:
+                result = await self.execute_node_async(statement)
+                if type(result) is tuple:
+                    return result[1]
+        finally:
+            self.frame = caller
+            pool.append(frame)
+
+    async def call_unresolved_async(self, params, body, args):
+        local_vars = self.variables.copy()
+        if self.frame is not None:
+            for name, index in self.frame.slots.items():
+                local_vars[name] = self.frame.values[index]
+        for param, arg in zip(params, flatten_arguments(args)):
+            local_vars[param] = await self.evaluate_async(arg)
+        executor = AsyncExecutor(body[1], self.hosts, self.yield_every, self.builtins)
+        executor.variables = local_vars
+        executor.functions = self.functions
+        executor.loader = self.loader
+        executor.modules = self.modules
+        if self.meter is not None:
+            self.meter.install(executor, root=False)
+        return await executor.execute()
+
+NUMERIC_TYPES = {'int', 'float', 'number', 'bool'}
+
+def join_types(left, right):
+    if left is None or left == right:
+        return right
+    if right is None:
+        return left
+    if left in NUMERIC_TYPES and right in NUMERIC_TYPES:
+        return 'number'
+    return 'unknown'
+
+def value_type(value):
+    if type(value) is bool:
+        return 'bool'
+    if type(value) is int:
+        return 'int'
+    if type(value) is float:
+        return 'float'
+    if type(value) is str:
+        return 'str'
+    return 'unknown'
+
+class TypeInference:
+    # flow-insensitive types for every expression and variable: int, float, number (int
+    # or float), bool, str or unknown. A name's type joins everything assigned to it or
+    # passed for it anywhere in the program; names nobody assigns take their type from
+    # inputs or stay unknown
+    def __init__(self, ast, inputs=None) -> None:
+        self.inputs = dict(inputs or {})
+        self.definitions = {}
+        for node in ast:
+            if node[0] == 'FUNCTION_DEF':
+                self.definitions.setdefault(node[1], []).append(node)
+        self.variables = dict(self.inputs)
+        self.returns = {}
+        self.types = {}
+        self.names = set()
+        # None is "no value seen yet"; once the optimistic pass settles, names nobody
+        # assigns and functions that can end without a return become unknown
+        self.solve(ast)
+        for name in self.names - set(self.variables):
+            self.variables[name] = 'unknown'
+        for func_name, nodes in self.definitions.items():
+            if not all(self.returns_always(node[3]) for node in nodes):
+                self.returns[func_name] = join_types(self.returns.get(func_name), 'unknown')
+        self.solve(ast)
+    
+    def solve(self, ast):
+        self.changed = True
+        while self.changed:
+            self.changed = False
+            for node in ast:
+                self.visit(node)
+    
+    def assign(self, name, kind):
+        if kind is None:
+            return
+        joined = join_types(self.variables.get(name), kind)
+        if joined != self.variables.get(name):
+            self.variables[name] = joined
+            self.changed = True
+    
+    def returns_always(self, node):
+        node_type = node[0] if type(node) is tuple else None
+        if node_type == 'RETURN':
+            return True
+        if node_type == 'BLOCK':
+            return any(self.returns_always(statement) for statement in node[1])
+        if node_type == 'CONDITION':
+            return node[3] is not None and self.returns_always(node[2]) and self.returns_always(node[3])
+        return False
+    
+    def visit(self, node, func_name=None):
+        node_type = node[0] if type(node) is tuple else None
+        if node_type == 'ASSIGN':
+            self.assign(node[1], self.infer(node[2]))
+        elif node_type == 'VAR':
+            self.visit(node[1], func_name)
+        elif node_type == 'BLOCK':
+            for statement in node[1]:
+                self.visit(statement, func_name)
+        elif node_type == 'CONDITION':
+            self.infer(node[1])
+            self.visit(node[2], func_name)
+            if node[3] is not None:
+                self.visit(node[3], func_name)
+        elif node_type in ('IF', 'WHILE'):
+            self.infer(node[1])
+            self.visit(node[2], func_name)
+        elif node_type == 'FOR':
+            self.visit(node[1], func_name)
+            self.infer(node[2])
+            self.visit(node[3], func_name)
+            self.visit(node[4], func_name)
+        elif node_type == 'FUNCTION_DEF':
+            self.visit(node[3], node[1])
+        elif node_type == 'RETURN':
+            kind = self.infer(node[1])
+            if func_name is not None:
+                joined = join_types(self.returns.get(func_name), kind)
+                if joined != self.returns.get(func_name):
+                    self.returns[func_name] = joined
+                    self.changed = True
+        elif node_type in ('EXPR', 'PRINT'):
+            self.infer(node[1])
+        else:
+            self.infer(node)
+    
+    def infer(self, expr):
+        kind = self.infer_expression(expr)
+        self.types[id(expr)] = kind
+        return kind
+    
+    def infer_expression(self, expr):
+        if type(expr) is tuple and len(expr) == 2 and type(expr[1]) is int:
+            return self.infer(expr[0])
+        if type(expr) is str:
+            if expr[:1].isdigit():
+                return value_type(parse_number(expr))
+            self.names.add(expr)
+            return self.variables.get(expr)
+        if type(expr) is not tuple:
+            return value_type(expr)
+        tag = expr[0]
+        if tag == 'FUNCTION_CALL':
+            _, func_name, args = expr
+            args = flatten_arguments(args)
+            kinds = [self.infer(arg) for arg in args]
+            definitions = self.definitions.get(func_name)
+            if not definitions:
+                return 'unknown'
+            for node in definitions:
+                params = node[2]
+                for param, kind in zip(params, kinds):
+                    if kind is not None:
+                        self.assign(param, kind)
+                # parameters without an argument keep the caller's value
+                for param in params[len(args):]:
+                    self.names.add(param)
+            return self.returns.get(func_name)
+        elif tag == 'COMPARE':
+            self.infer(expr[2])
+            self.infer(expr[3])
+            return 'bool'
+        elif tag == 'STRING':
+            return 'str'
+        elif tag == 'COMMA':
+            kind = 'unknown'
+            for item in expr[1]:
+                kind = self.infer(item)
+            return kind
+        elif len(expr) == 3 and tag in BINARY_OPERATORS:
+            left = self.infer(expr[1])
+            right = self.infer(expr[2])
+            if left is None or right is None:
+                return None
+            if left in NUMERIC_TYPES and right in NUMERIC_TYPES:
+                if tag == '/':
+                    return 'float'
+                if left == 'float' or right == 'float':
+                    return 'float'
+                if left == 'number' or right == 'number':
+                    return 'number'
+                return 'int'
+            if tag == '+' and left == 'str' and right == 'str':
+                return 'str'
+            return 'unknown'
+        return 'unknown'
+    
+    def type_of(self, expr):
+        return self.types.get(id(expr)) or 'unknown'
+
+TYPE_GUARDS = {
+    'int': 'type({0}) is int',
+    'float': 'type({0}) is float',
+    'number': '(type({0}) is int or type({0}) is float)',
+}
+
+SPECIALIZED_ROUTINES = {}
+# closures a TypedExecutor keeps, oldest dropped first
+TYPED_CLOSURE_LIMIT = 4096
+
+def specialized_routine(op, left_kind, right_kind, constant):
+    # builds, once per shape, a closure factory whose operator is inlined behind guards
+    # on the inferred operand types; operands that fail a guard go to the generic fallback
+    key = (op, left_kind, right_kind, constant)
+    factory = SPECIALIZED_ROUTINES.get(key)
+    if factory is None:
+        left = 'constant' if constant == 'left' else 'load_left()'
+        right = 'constant' if constant == 'right' else 'load_right()'
+        guards = []
+        if constant != 'left':
+            guards.append(TYPE_GUARDS[left_kind].format('left'))
+        if constant != 'right':
+            guards.append(TYPE_GUARDS[right_kind].format('right'))
+        source = (
+            'def factory(load_left, load_right, constant, fallback):\n'
+            '    def routine():\n'
+            f'        left = {left}\n'
+            f'        right = {right}\n'
+            f'        if {" and ".join(guards)}:\n'
+            f'            return left {op} right\n'
+            '        return fallback(left, right)\n'
+            '    return routine\n'
+        )
+        namespace = {}
+        exec(compile(source, f'<gscript routine {op} {left_kind} {right_kind}>', 'exec'), namespace)
+        factory = SPECIALIZED_ROUTINES[key] = namespace['factory']
+    return factory
+
+class TypedExecutor(GScriptExecutor):
+    # evaluates each expression through a closure built once per node. Inferred types pick
+    # the closure: operators whose operands are inferred int, float or number get a routine
+    # with the operator inlined behind type guards, constant subtrees fold and constant
+    # operands are bound into the routine. Operands that fail a guard, and operands of any
+    # other type, go through the generic operator
+    def __init__(self, ast, builtins=None, inputs=None) -> None:
+        super().__init__(ast, builtins)
+        self.inference = TypeInference(ast, inputs)
+        self.compiled = {}
+        self.compiled_limit = TYPED_CLOSURE_LIMIT
+        self.specialized = 0
+        self.generic = 0
+        self.guard_failures = 0
+
+    def evaluate_expression(self, expr):
+        entry = self.compiled.get(id(expr))
+        if entry is None or entry[0] is not expr:
+            return self.compiled_child(expr)()
+        return entry[1]()
+
+    def compile_expression(self, expr):
+        expr = strip_position(expr)
+        if type(expr) is bool or type(expr) is int or type(expr) is float:
+            return lambda: expr
+        if type(expr) is str:
+            if expr[:1].isdigit():
+                value = parse_number(expr)
+                return lambda: value
+            return self.compile_name(expr)
+        if type(expr) is not tuple:
+            return lambda: expr
+        tag = expr[0]
+        if tag == 'FUNCTION_CALL':
+            _, func_name, args = expr
+            return lambda: self.call_function(func_name, args)
+        elif tag == 'STRING':
+            value = expr[1][1:-1]
+            return lambda: value
+        elif tag == 'COMMA':
+            items = [self.compiled_child(item) for item in expr[1]]
+            def comma():
+                value = None
+                for item in items:
+                    value = item()
+                return value
+            return comma
+        elif tag == 'COMPARE':
+            _, op, left, right = expr
+            operation = COMPARE_OPERATORS[op]
+        elif len(expr) == 3 and tag in BINARY_OPERATORS:
+            op, left, right = expr
+            operation = BINARY_OPERATORS[op]
+        else:
+            return lambda: expr
+        
+        left_kind = self.inference.type_of(left)
+        right_kind = self.inference.type_of(right)
+        left_constant, left_value = self.constant(left)
+        right_constant, right_value = self.constant(right)
+        if left_constant and right_constant:
+            try:
+                value = operation(left_value, right_value)
+            except ArithmeticError:
+                pass
+            else:
+                return lambda: value
+        if left_kind in TYPE_GUARDS and right_kind in TYPE_GUARDS:
+            self.specialized += 1
+            def fallback(left_value, right_value):
+                self.guard_failures += 1
+                return operation(left_value, right_value)
+            if right_constant:
+                factory = specialized_routine(op, left_kind, right_kind, 'right')
+                return factory(self.compiled_child(left), None, right_value, fallback)
+            if left_constant:
+                factory = specialized_routine(op, left_kind, right_kind, 'left')
+                return factory(None, self.compiled_child(right), left_value, fallback)
+            factory = specialized_routine(op, left_kind, right_kind, None)
+            return factory(self.compiled_child(left), self.compiled_child(right), None, fallback)
+        self.generic += 1
+        load_left = self.compiled_child(left)
+        load_right = self.compiled_child(right)
+        return lambda: operation(load_left(), load_right())
+
+    def compiled_child(self, expr):
+        # entries keep their node alive, so an id maps to its own node until the entry is
+        # dropped; after that the node check below sends a reused id to a new closure
+        compiled = self.compiled
+        entry = compiled.get(id(expr))
+        if entry is None or entry[0] is not expr:
+            closure = self.compile_expression(expr)
+            if id(expr) not in compiled and len(compiled) >= self.compiled_limit:
+                del compiled[next(iter(compiled))]
+            entry = compiled[id(expr)] = (expr, closure)
+        return entry[1]
+
+    def constant(self, expr):
+        expr = strip_position(expr)
+        if type(expr) is int or type(expr) is float or type(expr) is bool:
+            return True, expr
+        if type(expr) is str and expr[:1].isdigit():
+            return True, parse_number(expr)
+        return False, None
+
+    def compile_name(self, name):
+        def load():
+            frame = self.frame
+            if frame is not None:
+                slot = frame.slots.get(name)
+                if slot is not None:
+                    return frame.values[slot]
+            return self.variables.get(name, 0)
+        return load
+
+OPCODES = [
+    'LOAD_CONST',
+    'LOAD_NAME',
+    'STORE_NAME',
+    'LOAD_FAST',
+    'STORE_FAST',
+    'BINARY_OP',
+    'COMPARE_OP',
+    'POP_TOP',
+    'JUMP',
+    'POP_JUMP_IF_FALSE',
+    'CALL_FUNCTION',
+    'MAKE_FUNCTION',
+    'RETURN_VALUE',
+    'CALL_BUILTIN',
+    'JUMP_IF_DEFINED',
+    'IMPORT_MODULE',
+    'JUMP_IF_IMPORTED',
+    'CALL_MODULE',
+]
+(LOAD_CONST, LOAD_NAME, STORE_NAME, LOAD_FAST, STORE_FAST, BINARY_OP, COMPARE_OP, POP_TOP,
+ JUMP, POP_JUMP_IF_FALSE, CALL_FUNCTION, MAKE_FUNCTION, RETURN_VALUE, CALL_BUILTIN,
+ JUMP_IF_DEFINED, IMPORT_MODULE, JUMP_IF_IMPORTED, CALL_MODULE) = range(len(OPCODES))
+
+BINARY_OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+
+COMPARE_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+}
+
+OPERATOR_SYMBOLS = {function: symbol for table in (BINARY_OPERATORS, COMPARE_OPERATORS)
+                    for symbol, function in table.items()}
+
+class CodeObject:
+    def __init__(self, name, params, instructions, varnames=()) -> None:
+        self.name = name
+        self.params = params
+        self.instructions = instructions
+        self.varnames = list(varnames)
+        self.nlocals = len(self.varnames)
+
+    def disassemble(self):
+        lines = [f'code {self.name}({", ".join(self.params)}):']
+        functions = []
+        for offset, (op, arg) in enumerate(self.instructions):
+            if op == MAKE_FUNCTION:
+                functions.append(arg)
+                arg = arg.name
+            elif op == BINARY_OP or op == COMPARE_OP:
+                arg = OPERATOR_SYMBOLS[arg]
+            elif op == CALL_FUNCTION or op == CALL_BUILTIN:
+                arg = f'{arg[0]} ({arg[1]} args)'
+            elif op == JUMP_IF_DEFINED:
+                arg = f'{arg[1]} (if {arg[0]} is defined)'
+            elif op == JUMP_IF_IMPORTED:
+                arg = f'{arg[1]} (if {arg[0]} is imported)'
+            elif op == CALL_MODULE:
+                arg = f'{arg[1].name} ({arg[2]} args, from {arg[0]})'
+            elif op == LOAD_FAST or op == STORE_FAST:
+                arg = f'{arg} ({self.varnames[arg]})'
+            elif op == LOAD_CONST:
+                arg = repr(arg)
+            lines.append(f'{offset:>6} {OPCODES[op]:<18} {"" if arg is None else arg}')
+        for function in functions:
+            lines.append('')
+            lines.append(function.disassemble())
+        return '\n'.join(lines)
+
+class BytecodeCompiler:
+    def __init__(self, scopes=None, scope=None, builtins=None, loader=None) -> None:
+        self.scopes = scopes
+        self.scope = scope
+        self.builtins = builtins
+        self.loader = loader
+        self.modules = []
+        self.module_codes = {}
+
+    def compile(self, ast, name='<main>', params=()):
+        if self.scopes is None:
+            self.modules = imported_modules(ast, self.loader)
+            resolver = ScopeResolver()
+            self.scopes = resolver.resolve(ast, self.modules)
+            if resolver.conflicts:
+                message = f'Cannot compile conflicting definitions of {", ".join(sorted(resolver.conflicts))}'
+                raise RuntimeError(message)
+        self.instructions = []
+        for node in ast:
+            self.compile_statement(node)
+        self.emit(LOAD_CONST, None)
+        self.emit(RETURN_VALUE)
+        varnames = self.scope.names if self.scope is not None else ()
+        return CodeObject(name, list(params), self.instructions, varnames)
+
+    def nested(self, scope):
+        # compiles a function body against the program's scopes and imports
+        compiler = BytecodeCompiler(self.scopes, scope, self.builtins, self.loader)
+        compiler.modules = self.modules
+        compiler.module_codes = self.module_codes
+        return compiler
+
+    def emit(self, op, arg=None):
+        self.instructions.append((op, arg))
+        return len(self.instructions) - 1
+
+    def patch(self, offset, target):
+        self.instructions[offset] = (self.instructions[offset][0], target)
+
+    def compile_statement(self, node):
+        node_type = node[0]
+        if node_type == 'ASSIGN':
+            _, var_name, var_value = node
+            self.compile_expression(var_value)
+            if self.scope is not None and var_name in self.scope.slots:
+                self.emit(STORE_FAST, self.scope.slots[var_name])
+            else:
+                self.emit(STORE_NAME, var_name)
+        elif node_type == 'VAR':
+            self.compile_statement(node[1])
+        elif node_type == 'BLOCK':
+            for statement in node[1]:
+                self.compile_statement(statement)
+        elif node_type == 'CONDITION' or node_type == 'IF':
+            body_else = node[3] if node_type == 'CONDITION' else None
+            self.compile_expression(node[1])
+            jump_else = self.emit(POP_JUMP_IF_FALSE)
+            self.compile_statement(node[2])
+            if body_else is None:
+                self.patch(jump_else, len(self.instructions))
+            else:
+                jump_end = self.emit(JUMP)
+                self.patch(jump_else, len(self.instructions))
+                self.compile_statement(body_else)
+                self.patch(jump_end, len(self.instructions))
+        elif node_type == 'WHILE':
+            _, condition, body = node
+            start = len(self.instructions)
+            self.compile_expression(condition)
+            jump_end = self.emit(POP_JUMP_IF_FALSE)
+            self.compile_statement(body)
+            self.emit(JUMP, start)
+            self.patch(jump_end, len(self.instructions))
+        elif node_type == 'FOR':
+            _, init, condition, increment, body = node
+            self.compile_statement(init)
+            start = len(self.instructions)
+            self.compile_expression(condition)
+            jump_end = self.emit(POP_JUMP_IF_FALSE)
+            self.compile_statement(body)
+            self.compile_statement(increment)
+            self.emit(JUMP, start)
+            self.patch(jump_end, len(self.instructions))
+        elif node_type == 'FUNCTION_DEF':
+            _, func_name, params, body = node
+            code = self.nested(self.scopes[func_name]).compile(body[1], func_name, params)
+            self.emit(MAKE_FUNCTION, code)
+        elif node_type == 'IMPORT':
+            self.emit(IMPORT_MODULE, imported_modules([node], self.loader)[0].path)
+        elif node_type == 'RETURN':
+            self.compile_expression(node[1])
+            self.emit(RETURN_VALUE)
+        elif node_type == 'PRINT' or node_type == 'EXPR':
+            self.compile_expression(node[1])
+            self.emit(POP_TOP)
+        else:
+            self.compile_expression(node)
+            self.emit(POP_TOP)
+
+    def compile_expression(self, expr):
+        expr = strip_position(expr)
+        if expr is None or isinstance(expr, (int, float)):
+            self.emit(LOAD_CONST, expr)
+        elif isinstance(expr, str):
+            if expr[:1].isdigit():
+                self.emit(LOAD_CONST, parse_number(expr))
+            elif self.scope is not None and expr in self.scope.slots:
+                self.emit(LOAD_FAST, self.scope.slots[expr])
+            else:
+                self.emit(LOAD_NAME, expr)
+        elif isinstance(expr, tuple):
+            tag = expr[0]
+            if tag == 'FUNCTION_CALL':
+                self.compile_call(expr)
+            elif tag == 'COMPARE':
+                _, op, left, right = expr
+                self.compile_expression(left)
+                self.compile_expression(right)
+                self.emit(COMPARE_OP, COMPARE_OPERATORS[op])
+            elif tag == 'STRING':
+                self.emit(LOAD_CONST, expr[1][1:-1])
+            elif tag == 'COMMA':
+                for index, item in enumerate(expr[1]):
+                    if index:
+                        self.emit(POP_TOP)
+                    self.compile_expression(item)
+            elif len(expr) == 3 and tag in BINARY_OPERATORS:
+                self.compile_expression(expr[1])
+                self.compile_expression(expr[2])
+                self.emit(BINARY_OP, BINARY_OPERATORS[tag])
+            else:
+                self.emit(LOAD_CONST, expr)
+        else:
+            message = f'Cannot compile expression {expr!r}'
+            raise RuntimeError(message)
+
+    def call_candidates(self, func_name):
+        # what a call may reach, in the order GScriptExecutor.call_function tries them: the
+        # script's function once its definition has run, imported ones, then the builtin
+        candidates = []
+        if func_name in self.scopes:
+            candidates.append((JUMP_IF_DEFINED, func_name, self.scopes[func_name]))
+        for module in self.modules:
+            if func_name in module.functions:
+                candidates.append((JUMP_IF_IMPORTED, module, module.resolver.scope(func_name)))
+        if self.builtins is not None and func_name in self.builtins.builtins:
+            candidates.append((CALL_BUILTIN, None, None))
+        return candidates
+
+    def compile_call(self, expr):
+        candidates = self.call_candidates(expr[1])
+        if not candidates:
+            # like GScriptExecutor, a call to an unknown function evaluates to None
+            self.emit(LOAD_CONST, None)
+            return
+        # every candidate but the last sits behind a check; the last is called directly
+        # and evaluates to None itself when its function is not there
+        checks = [self.emit(check) for check, _, _ in candidates[:-1]]
+        order = [len(candidates) - 1] + list(range(len(candidates) - 1))
+        jumps = []
+        for index in order:
+            check, target, scope = candidates[index]
+            if index < len(checks):
+                key = target if check == JUMP_IF_DEFINED else target.path
+                self.patch(checks[index], (key, len(self.instructions)))
+            if check == CALL_BUILTIN:
+                self.compile_builtin_call(expr)
+            else:
+                args = flatten_arguments(expr[2])[:len(scope.params)]
+                for arg in args:
+                    self.compile_expression(arg)
+                # missing parameters and the callee's free names come from this scope
+                for name in scope.params[len(args):] + scope.free:
+                    self.compile_expression(name)
+                argc = len(scope.params) + len(scope.free)
+                if check == JUMP_IF_DEFINED:
+                    self.emit(CALL_FUNCTION, (expr[1], argc))
+                else:
+                    self.emit(CALL_MODULE, (target.path, self.module_code(target, expr[1]), argc))
+            if index != order[-1]:
+                jumps.append(self.emit(JUMP))
+        for offset in jumps:
+            self.patch(offset, len(self.instructions))
+
+    def module_code(self, module, func_name):
+        # an imported function compiles once per program, in its module's scope
+        key = (module.path, func_name)
+        code = self.module_codes.get(key)
+        if code is None:
+            params, body = module.functions[func_name]
+            scope = module.resolver.scope(func_name)
+            code = self.module_codes[key] = CodeObject(func_name, list(params), [], scope.names)
+            code.instructions = self.nested(scope).compile(body[1], func_name, params).instructions
+        return code
+
+    def compile_builtin_call(self, expr):
+        args = flatten_arguments(expr[2])
+        for arg in args:
+            self.compile_expression(arg)
+        self.emit(CALL_BUILTIN, (expr[1], len(args)))
+
+class GScriptVM:
+    def __init__(self, code, builtins=None, loader=None):
+        if not isinstance(code, CodeObject):
+            code = BytecodeCompiler(builtins=builtins, loader=loader).compile(code)
+        self.code = code
+        self.builtins = builtins
+        self.variables = {}
+        self.functions = {}
+        self.imported = set()
+
+    def execute(self):
+        return self.run(self.code, self.variables, None)
+
+    def run(self, code, variables, fast):
+        instructions = code.instructions
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        pc = 0
+        while True:
+            op, arg = instructions[pc]
+            pc += 1
+            if op == LOAD_FAST:
+                push(fast[arg])
+            elif op == STORE_FAST:
+                fast[arg] = pop()
+            elif op == LOAD_NAME:
+                push(variables.get(arg, 0))
+            elif op == LOAD_CONST:
+                push(arg)
+            elif op == STORE_NAME:
+                variables[arg] = pop()
+            elif op == BINARY_OP:
+                right = pop()
+                stack[-1] = arg(stack[-1], right)
+            elif op == COMPARE_OP:
+                right = pop()
+                stack[-1] = arg(stack[-1], right)
+            elif op == POP_JUMP_IF_FALSE:
+                if not pop():
+                    pc = arg
+            elif op == JUMP:
+                pc = arg
+            elif op == POP_TOP:
+                pop()
+            elif op == CALL_FUNCTION:
+                func_name, argc = arg
+                if argc:
+                    args = stack[-argc:]
+                    del stack[-argc:]
+                else:
+                    args = []
+                push(self.call_function(func_name, args))
+            elif op == CALL_BUILTIN:
+                func_name, argc = arg
+                if argc:
+                    args = stack[-argc:]
+                    del stack[-argc:]
+                else:
+                    args = []
+                if self.builtins is None:
+                    message = f'Code calls builtin {func_name} but the VM has no builtins'
+                    raise RuntimeError(message)
+                push(self.builtins.call(func_name, args))
+            elif op == RETURN_VALUE:
+                return pop()
+            elif op == MAKE_FUNCTION:
+                self.functions[arg.name] = arg
+            elif op == JUMP_IF_DEFINED:
+                if arg[0] in self.functions:
+                    pc = arg[1]
+            elif op == IMPORT_MODULE:
+                self.imported.add(arg)
+            elif op == JUMP_IF_IMPORTED:
+                if arg[0] in self.imported:
+                    pc = arg[1]
+            elif op == CALL_MODULE:
+                path, code, argc = arg
+                if argc:
+                    args = stack[-argc:]
+                    del stack[-argc:]
+                else:
+                    args = []
+                if path in self.imported:
+                    if code.nlocals > len(args):
+                        args.extend([0] * (code.nlocals - len(args)))
+                    push(self.run(code, self.variables, args))
+                else:
+                    push(None)
+
+    def call_function(self, func_name, args):
+        code = self.functions.get(func_name)
+        if code is not None:
+            if code.nlocals > len(args):
+                args.extend([0] * (code.nlocals - len(args)))
+            return self.run(code, self.variables, args)
+
+# compiled code objects keyed by generated source, least recently used evicted first
+PYTHON_CODE_CACHE = OrderedDict()
+PYTHON_CODE_CACHE_SIZE = 512
+PYTHON_CODE_LOCK = threading.Lock()
+
+class TranspiledProgram:
+    def __init__(self, source, functions, main, constants, line_positions, spans=None, builtins=None) -> None:
+        # functions: [(python name, source)], main: source of the entry point
+        self.source = source
+        self.functions = functions
+        self.main = main
+        self.constants = constants
+        self.line_positions = line_positions
+        self.spans = spans
+        self.builtins = builtins
+
+    def to_module(self):
+        return ast_module.parse(self.source)
+
+    def load(self, source, name):
+        filename = f'<gscript {name}:{hashlib.sha1(source.encode()).hexdigest()[:8]}>'
+        with PYTHON_CODE_LOCK:
+            code = PYTHON_CODE_CACHE.get(source)
+            if code is not None:
+                PYTHON_CODE_CACHE.move_to_end(source)
+                return code
+        code = compile(source, filename, 'exec')
+        with PYTHON_CODE_LOCK:
+            PYTHON_CODE_CACHE[source] = code
+            while len(PYTHON_CODE_CACHE) > PYTHON_CODE_CACHE_SIZE:
+                PYTHON_CODE_CACHE.popitem(last=False)
+        return code
+
+    def execute(self, variables=None):
+        if variables is None:
+            variables = {}
+        namespace = {'F': {}, 'I': set(), 'K': self.constants,
+                     'B': self.builtins.call if self.builtins is not None else None}
+        for python_name, source in self.functions:
+            exec(self.load(source, python_name), namespace)
+            namespace[python_name] = namespace.pop('gscript_function')
+        exec(self.load(self.main, '<main>'), namespace)
+        try:
+            return namespace['gscript_function'](variables)
+        except Exception as error:
+            self.annotate(error)
+            raise
+
+    def locate(self, filename, lineno):
+        source = self.main if filename.startswith('<gscript <main>') else None
+        for python_name, function_source in self.functions:
+            if filename.startswith(f'<gscript {python_name}:'):
+                source = function_source
+        if source is None:
+            return None
+        position = self.line_positions.get((source, lineno))
+        if position is None:
+            return None
+        if self.spans is not None and position < len(self.spans):
+            return (position,) + self.spans.line_column(position)
+        return (position,)
+
+    def annotate(self, error):
+        location = None
+        tb = error.__traceback__
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            if code.co_filename.startswith('<gscript '):
+                location = self.locate(code.co_filename, tb.tb_lineno) or location
+            tb = tb.tb_next
+        if location is not None and hasattr(error, 'add_note'):
+            if len(location) == 3:
+                error.add_note(f'GScript line {location[1]}, column {location[2]} (token {location[0]})')
+            else:
+                error.add_note(f'GScript token {location[0]}')
+
+class PythonTranspiler:
+    def __init__(self, spans=None, builtins=None, loader=None) -> None:
+        self.spans = spans
+        self.builtins = builtins
+        self.loader = loader
+
+    def transpile(self, ast):
+        self.constants = []
+        self.line_positions = {}
+        self.modules = imported_modules(ast, self.loader)
+        self.module_functions = {}
+        resolver = ScopeResolver()
+        self.scopes = resolver.resolve(ast, self.modules)
+        if resolver.conflicts:
+            message = f'Cannot transpile conflicting definitions of {", ".join(sorted(resolver.conflicts))}'
+            raise RuntimeError(message)
+        definitions = [node for node in ast if node[0] == 'FUNCTION_DEF']
+        
+        functions = []
+        self.python_names = {}
+        for index, node in enumerate(definitions):
+            self.python_names[id(node)] = f'f{index}_{node[1]}'
+        for node in definitions:
+            _, func_name, params, body = node
+            functions.append((self.python_names[id(node)], self.compile_function(self.scopes[func_name], body)))
+        
+        reads, writes, calls = set(), set(), set()
+        resolver.collect_names(('BLOCK', ast), reads, writes, calls, False)
+        for callee in calls:
+            for scope in (self.scopes.get(callee), resolver.imported.get(callee)):
+                if scope is not None:
+                    reads.update(scope.free)
+        names = sorted(reads | writes)
+        self.available = None
+        self.lines = [('def gscript_function(G):', None)]
+        self.indent = 1
+        # w_ flags record which globals exist or were assigned, so a global that is only
+        # read before its first assignment is not created by the write-back
+        for name in names:
+            self.emit(f'v_{name} = G.get({name!r}, 0)', None)
+            if name in writes:
+                self.emit(f'w_{name} = {name!r} in G', None)
+        self.flagged = writes
+        self.emit('try:', None)
+        self.indent = 2
+        self.compile_block(ast)
+        self.indent = 1
+        self.emit('finally:', None)
+        self.indent = 2
+        for name in sorted(writes):
+            self.emit(f'if w_{name}: G[{name!r}] = v_{name}', None)
+        if not writes:
+            self.emit('pass', None)
+        main = self.finish()
+        
+        # imported functions called above, and the ones they call in turn
+        compiled = set()
+        while len(compiled) < len(self.module_functions):
+            for key, python_name in list(self.module_functions.items()):
+                if python_name not in compiled:
+                    compiled.add(python_name)
+                    module, func_name = key
+                    body = module.functions[func_name][1]
+                    functions.append((python_name, self.compile_function(module.resolver.scope(func_name), body)))
+        
+        source = '\n\n'.join([source for _, source in functions] + [main])
+        return TranspiledProgram(source, functions, main, self.constants, self.line_positions, self.spans, self.builtins)
+
+    def compile_function(self, scope, body):
+        arguments = [f'v_{name}' for name in scope.params + scope.free]
+        self.lines = [(f'def gscript_function({", ".join(arguments)}):', None)]
+        self.indent = 1
+        self.flagged = ()
+        self.available = set(scope.names)
+        self.compile_block(body[1])
+        if len(self.lines) == 1:
+            self.emit('pass', None)
+        return self.finish()
+
+    def finish(self):
+        source = '\n'.join(line for line, _ in self.lines) + '\n'
+        for lineno, (_, position) in enumerate(self.lines, 1):
+            if position is not None:
+                self.line_positions[(source, lineno)] = position
+        return source
+
+    def emit(self, line, position):
+        self.lines.append(('    ' * self.indent + line, position))
+
+    def compile_block(self, statements):
+        start = len(self.lines)
+        for statement in statements:
+            self.compile_statement(statement)
+        if len(self.lines) == start:
+            self.emit('pass', None)
+
+    def compile_statement(self, node):
+        position = first_position(node)
+        node_type = node[0]
+        if node_type == 'ASSIGN':
+            _, var_name, var_value = node
+            self.emit(f'v_{var_name} = {self.expression(var_value)}', position)
+            if var_name in self.flagged:
+                self.emit(f'w_{var_name} = True', position)
+        elif node_type == 'VAR':
+            self.compile_statement(node[1])
+        elif node_type == 'BLOCK':
+            self.compile_block(node[1])
+        elif node_type == 'CONDITION' or node_type == 'IF':
+            body_else = node[3] if node_type == 'CONDITION' else None
+            self.emit(f'if {self.expression(node[1])}:', position)
+            self.indent += 1
+            self.compile_statement(node[2])
+            self.indent -= 1
+            if body_else is not None:
+                self.emit('else:', position)
+                self.indent += 1
+                self.compile_statement(body_else)
+                self.indent -= 1
+        elif node_type == 'WHILE':
+            _, condition, body = node
+            self.emit(f'while {self.expression(condition)}:', position)
+            self.indent += 1
+            self.compile_statement(body)
+            self.indent -= 1
+        elif node_type == 'FOR':
+            _, init, condition, increment, body = node
+            self.compile_statement(init)
+            self.emit(f'while {self.expression(condition)}:', first_position(condition))
+            self.indent += 1
+            self.compile_statement(body)
+            self.compile_statement(increment)
+            self.indent -= 1
+        elif node_type == 'FUNCTION_DEF':
+            self.emit(f'F[{node[1]!r}] = {self.python_names[id(node)]}', position)
+        elif node_type == 'IMPORT':
+            self.emit(f'I.add({imported_modules([node], self.loader)[0].path!r})', position)
+        elif node_type == 'RETURN':
+            self.emit(f'return {self.expression(node[1])}', position)
+        elif node_type == 'PRINT':
+            self.emit(f'print({self.expression(node[1])})', position)
+        elif node_type == 'EXPR':
+            self.emit(self.expression(node[1]), position)
+        else:
+            self.emit(self.expression(node), position)
+
+    def expression(self, expr):
+        expr = strip_position(expr)
+        if type(expr) is bool or type(expr) is int or type(expr) is float:
+            return repr(expr)
+        elif type(expr) is str:
+            if expr[:1].isdigit():
+                return repr(parse_number(expr))
+            return f'v_{expr}'
+        elif type(expr) is tuple:
+            tag = expr[0]
+            if tag == 'FUNCTION_CALL':
+                _, func_name, args = expr
+                args = flatten_arguments(args)
+                # built from the last candidate back, so the first one there at run time wins
+                value = 'None'
+                for condition, function, scope in reversed(self.call_candidates(func_name)):
+                    if function is None:
+                        value = f'B({func_name!r}, [{", ".join(self.expression(arg) for arg in args)}])'
+                        continue
+                    values = [self.expression(arg) for arg in args[:len(scope.params)]]
+                    for name in scope.params[len(values):] + scope.free:
+                        if self.available is not None and name not in self.available:
+                            message = f'Cannot transpile the call to {func_name}: the caller has no {name} to pass'
+                            raise RuntimeError(message)
+                        values.append(f'v_{name}')
+                    value = f'({function}({", ".join(values)}) if {condition} else {value})'
+                return value
+            elif tag == 'COMPARE':
+                _, op, left, right = expr
+                return f'({self.expression(left)} {op} {self.expression(right)})'
+            elif tag == 'STRING':
+                return repr(expr[1][1:-1])
+            elif tag == 'COMMA':
+                return f'({", ".join(self.expression(item) for item in expr[1])},)[-1]'
+            elif len(expr) == 3 and tag in BINARY_OPERATORS:
+                return f'({self.expression(expr[1])} {tag} {self.expression(expr[2])})'
+        self.constants.append(expr)
+        return f'K[{len(self.constants) - 1}]'
+
+    def call_candidates(self, func_name):
+        # (condition, function, scope) for what a call may reach, in the order
+        # GScriptExecutor.call_function tries them; the builtin has no function
+        candidates = []
+        if func_name in self.scopes:
+            candidates.append((f'{func_name!r} in F', f'F[{func_name!r}]', self.scopes[func_name]))
+        for module in self.modules:
+            if func_name in module.functions:
+                python_name = self.module_functions.setdefault(
+                    (module, func_name), f'm{len(self.module_functions)}_{func_name}')
+                candidates.append((f'{module.path!r} in I', python_name, module.resolver.scope(func_name)))
+        if self.builtins is not None and func_name in self.builtins.builtins:
+            candidates.append((None, None, None))
+        return candidates
+
+def first_position(node):
+    # token position of the first (expr, position) pair inside a node
+    if type(node) is tuple:
+        if len(node) == 2 and type(node[1]) is int:
+            return node[1]
+        for item in node:
+            position = first_position(item)
+            if position is not None:
+                return position
+    elif type(node) is list:
+        for item in node:
+            position = first_position(item)
+            if position is not None:
+                return position
+    return None
+
+class LoopTranspiler(PythonTranspiler):
+    # compiles one loop into a Python function over local copies of the names it uses.
+    # Returns leave as ('RETURN', value) like execute_node, builtins go through B
+    def transpile_loop(self, node, slots):
+        self.constants = []
+        self.line_positions = {}
+        self.scopes = {}
+        self.modules = []
+        self.python_names = {}
+        self.flagged = ()
+        self.available = None
+        resolver = ScopeResolver()
+        resolver.prepare(())
+        reads, writes, calls = set(), set(), set()
+        resolver.collect_names(node, reads, writes, calls, False)
+        if node[0] == 'FOR':
+            _, init, condition, increment, body = node
+            node = ('WHILE', condition, ('BLOCK', [body, increment]))
+        
+        names = sorted(reads | writes)
+        self.lines = [('def gscript_loop(S, G):', None)]
+        self.indent = 1
+        for name in names:
+            if slots is not None and name in slots:
+                self.emit(f'v_{name} = S[{slots[name]}]', None)
+            else:
+                self.emit(f'v_{name} = G.get({name!r}, 0)', None)
+        self.emit('try:', None)
+        self.indent = 2
+        self.compile_statement(node)
+        self.indent = 1
+        self.emit('finally:', None)
+        self.indent = 2
+        for name in sorted(writes):
+            if slots is not None and name in slots:
+                self.emit(f'S[{slots[name]}] = v_{name}', None)
+            else:
+                self.emit(f'G[{name!r}] = v_{name}', None)
+        if not writes:
+            self.emit('pass', None)
+        return self.finish(), sorted(writes)
+
+    def compile_statement(self, node):
+        if node[0] == 'RETURN':
+            self.emit(f'return ("RETURN", {self.expression(node[1])})', first_position(node))
+        else:
+            super().compile_statement(node)
+
+class TieredExecutor(GScriptExecutor):
+    # interprets every loop until it has run threshold iterations in total, then compiles
+    # it with LoopTranspiler and switches to the compiled form between two iterations.
+    # An entry falls back to the interpreter when a name the loop assigns does not exist
+    # yet or when a meter or profiler needs to see every node. A meter cannot be installed
+    # while a compiled loop runs, since that loop would never check it
+    def __init__(self, ast, builtins=None, threshold=100) -> None:
+        super().__init__(ast, builtins)
+        self.threshold = threshold
+        self.loops = {}
+        self.compiled = {}
+        self.compiled_depth = 0
+        self.defined = set()
+        stack = list(ast)
+        while stack:
+            item = stack.pop()
+            if type(item) is tuple and item and item[0] == 'FUNCTION_DEF':
+                # bodies are not searched, so lazy bodies stay unparsed
+                self.defined.add(item[1])
+            elif type(item) is tuple or type(item) is list:
+                stack.extend(item)
+
+    def execute_node(self, node):
+        node_type = node[0]
+        if node_type == 'WHILE' or node_type == 'FOR':
+            return self.execute_loop(node)
+        return GScriptExecutor.execute_node(self, node)
+
+    def execute_loop(self, node):
+        loop = self.loops.get(id(node))
+        if loop is None:
+            loop = self.loops[id(node)] = {
+                'kind': node[0],
+                'position': first_position(node),
+                'iterations': 0,
+                'promoted': False,
+                'compiled_runs': 0,
+                'deopts': 0,
+                'builtins': set(),
+            }
+            loop['reason'] = self.blocker(node, loop['builtins'])
+        if node[0] == 'FOR':
+            _, init, condition, increment, body = node
+            self.execute_node(init)
+        else:
+            _, condition, body = node
+            increment = None
+        
+        if loop['promoted']:
+            ran, result = self.run_compiled(node, loop)
+            if ran:
+                return result
+        remaining = self.threshold - loop['iterations'] if loop['reason'] is None and self.threshold is not None else -1
+        count = 0
+        try:
+            while self.evaluate_expression(condition):
+                result = self.execute_node(body)
+                if type(result) is tuple:
+                    return result
+                if increment is not None:
+                    self.execute_node(increment)
+                count += 1
+                if count == remaining:
+                    loop['promoted'] = True
+                    ran, result = self.run_compiled(node, loop)
+                    if ran:
+                        return result
+        finally:
+            loop['iterations'] += count
+
+    def blocker(self, node, builtins):
+        stack = [node]
+        while stack:
+            item = stack.pop()
+            if type(item) is tuple or type(item) is list:
+                if item and item[0] == 'FUNCTION_CALL':
+                    func_name = item[1]
+                    if (self.builtins is None or func_name not in self.builtins.builtins
+                            or self.shadowed(func_name)):
+                        return f'calls {func_name}'
+                    builtins.add(func_name)
+                elif item and (item[0] == 'FUNCTION_DEF' or item[0] == 'IMPORT'):
+                    return f'contains {item[0]}'
+                stack.extend(item)
+        return None
+
+    def shadowed(self, func_name):
+        # script functions win over builtins in call_function, so compiled loops must not
+        # call a builtin that a script or imported function of the same name hides
+        return (func_name in self.defined or func_name in self.functions
+                or any(func_name in module.functions for module in self.modules))
+
+    def run_compiled(self, node, loop):
+        # compiled code skips execute_node, so meters and profilers would miss its steps
+        frame = self.frame
+        slots = frame.slots if frame is not None else None
+        key = (id(node), id(slots))
+        entry = self.compiled.get(key)
+        if entry is None:
+            transpiler = LoopTranspiler(builtins=self.builtins)
+            source, writes = transpiler.transpile_loop(node, slots)
+            if transpiler.constants:
+                loop['promoted'] = False
+                loop['reason'] = 'unsupported expression'
+                return False, None
+            namespace = {'B': self.builtins.call if self.builtins is not None else None}
+            exec(compile(source, f'<gscript loop {loop["position"]}>', 'exec'), namespace)
+            entry = self.compiled[key] = (namespace['gscript_loop'], writes)
+        function, writes = entry
+        variables = self.variables
+        if (self.meter is not None or self.profiler is not None
+                or any(self.shadowed(func_name) for func_name in loop['builtins'])
+                or any(name not in variables for name in writes if slots is None or name not in slots)):
+            loop['deopts'] += 1
+            return False, None
+        loop['compiled_runs'] += 1
+        self.compiled_depth += 1
+        try:
+            return True, function(frame.values if frame is not None else None, variables)
+        finally:
+            self.compiled_depth -= 1
+
+    def stats(self):
+        report = {}
+        for loop in self.loops.values():
+            report[f'{loop["kind"]}@{loop["position"]}'] = dict(loop, builtins=sorted(loop['builtins']))
+        return report
+
+class BatchUnsupported(RuntimeError):
+    pass
+
+class BatchFrame:
+    __slots__ = ('returned', 'value', 'assigned')
+    
+    def __init__(self, assigned=None) -> None:
+        self.returned = None
+        self.value = None
+        self.assigned = assigned
+
+class BatchExecutor:
+    # runs one program over many rows at once: variables hold numpy columns, conditions
+    # and loops run under boolean row masks, anything else falls back to one
+    # GScriptExecutor per row
+    def __init__(self, ast, builtins=None) -> None:
+        self.ast = ast
+        self.builtins = builtins
+        self.functions = {}
+        self.mode = None
+        self.fallback_reason = None
+        self.assigned = {}
+
+    def execute_batch(self, columns, size=None):
+        if size is None:
+            lengths = {len(value) for value in columns.values() if not self.is_scalar(value)}
+            if len(lengths) > 1:
+                message = f'Batch columns have different lengths {sorted(lengths)}'
+                raise RuntimeError(message)
+            size = lengths.pop() if lengths else 1
+        self.size = size
+        self.functions = {}
+        self.assigned = {}
+        self.fallback_reason = None
+        if numpy is None:
+            self.fallback_reason = 'numpy is not installed'
+        else:
+            try:
+                with numpy.errstate(divide='raise', invalid='raise', over='raise'):
+                    variables = self.execute_vectorized(columns)
+                self.mode = 'vectorized'
+                return variables
+            except (BatchUnsupported, ArithmeticError, TypeError, ValueError) as error:
+                self.fallback_reason = f'{type(error).__name__}: {error}'
+        self.mode = 'per-row'
+        return self.execute_rows(columns)
+
+    def is_scalar(self, value):
+        return isinstance(value, (int, float, str)) or value is None
+
+    def scalar(self, value):
+        # numpy scalars become Python ones so rows compute exactly as GScriptExecutor does
+        return value.item() if numpy is not None and isinstance(value, numpy.generic) else value
+
+    def execute_rows(self, columns):
+        rows = []
+        self.results = []
+        for index in range(self.size):
+            executor = GScriptExecutor(self.ast, self.builtins)
+            executor.variables = {name: value if self.is_scalar(value) else self.scalar(value[index])
+                                  for name, value in columns.items()}
+            self.results.append(executor.execute())
+            rows.append(executor.variables)
+        names = []
+        for row in rows:
+            names.extend(name for name in row if name not in names)
+        variables = {}
+        for name in names:
+            values = [row.get(name, 0) for row in rows]
+            assigned = [name in row for row in rows]
+            if numpy is not None:
+                values = numpy.asarray(values)
+                assigned = numpy.asarray(assigned)
+            variables[name] = values
+            self.assigned[name] = assigned
+        return variables
+
+    def execute_vectorized(self, columns):
+        env = {}
+        for name, value in columns.items():
+            if self.is_scalar(value):
+                if type(value) is str:
+                    raise BatchUnsupported('string input')
+                env[name] = value
+            else:
+                column = numpy.asarray(value)
+                if column.dtype.kind not in 'biuf':
+                    raise BatchUnsupported(f'column {name} has dtype {column.dtype}')
+                env[name] = column
+        assigned = {name: None for name in env}
+        frame = BatchFrame(assigned)
+        self.run(self.ast, env, None, frame)
+        self.results = self.full(frame.value) if frame.value is not None else None
+        variables = {}
+        for name, value in env.items():
+            variables[name] = self.full(value)
+            mask = assigned[name]
+            self.assigned[name] = numpy.ones(self.size, bool) if mask is None else mask
+        return variables
+
+    def full(self, value):
+        return numpy.broadcast_to(numpy.asarray(value), (self.size,)).copy()
+
+    def live(self, active, frame):
+        if frame.returned is None:
+            return active
+        if active is None:
+            return ~frame.returned
+        return active & ~frame.returned
+
+    def run(self, statements, env, active, frame):
+        for statement in statements:
+            current = self.live(active, frame)
+            if current is not None and not current.any():
+                return
+            self.execute_statement(statement, env, current, frame)
+
+    def truth(self, value):
+        if isinstance(value, numpy.ndarray):
+            if value.dtype.kind == 'b':
+                return value
+            if value.dtype.kind in 'iuf':
+                return value != 0
+            raise BatchUnsupported(f'condition of dtype {value.dtype}')
+        if type(value) is str or value is None:
+            raise BatchUnsupported('non-numeric condition')
+        return bool(value)
+
+    def restrict(self, active, mask):
+        if type(mask) is bool:
+            if active is None:
+                return None if mask else numpy.zeros(self.size, bool)
+            return active if mask else numpy.zeros(self.size, bool)
+        if active is None:
+            return mask
+        return active & mask
+
+    def assign(self, env, name, value, active, frame):
+        if value is None or type(value) is str:
+            raise BatchUnsupported(f'non-numeric value for {name}')
+        if active is None:
+            env[name] = value
+        else:
+            env[name] = numpy.where(active, value, env.get(name, 0))
+        if frame.assigned is not None:
+            previous = frame.assigned.get(name, False)
+            if active is None or previous is None:
+                frame.assigned[name] = None
+            else:
+                frame.assigned[name] = active | previous
+
+    def execute_statement(self, node, env, active, frame):
+        node_type = node[0]
+        if node_type == 'ASSIGN':
+            _, var_name, var_value = node
+            self.assign(env, var_name, self.evaluate(var_value, env, active), active, frame)
+        elif node_type == 'VAR':
+            self.execute_statement(node[1], env, active, frame)
+        elif node_type == 'BLOCK':
+            self.run(node[1], env, active, frame)
+        elif node_type == 'CONDITION':
+            _, condition, body_if, body_else = node
+            mask = self.truth(self.evaluate(condition, env, active))
+            self.run(body_if[1], env, self.restrict(active, mask), frame)
+            if body_else is not None:
+                self.run(body_else[1], env, self.restrict(active, ~mask if type(mask) is not bool else not mask), frame)
+        elif node_type == 'WHILE' or node_type == 'FOR':
+            if node_type == 'FOR':
+                _, init, condition, increment, body = node
+                self.execute_statement(init, env, active, frame)
+            else:
+                _, condition, body = node
+                increment = None
+            while True:
+                current = self.live(active, frame)
+                mask = self.restrict(current, self.truth(self.evaluate(condition, env, current)))
+                if mask is not None and not mask.any():
+                    break
+                self.run(body[1], env, mask, frame)
+                if increment is not None:
+                    self.execute_statement(increment, env, self.live(mask, frame), frame)
+        elif node_type == 'FUNCTION_DEF':
+            _, func_name, params, body = node
+            self.functions[func_name] = (params, body)
+        elif node_type == 'RETURN':
+            value = self.evaluate(node[1], env, active)
+            if value is None or type(value) is str:
+                raise BatchUnsupported('non-numeric return value')
+            if active is None:
+                frame.value = value
+                frame.returned = numpy.ones(self.size, bool)
+            else:
+                frame.value = numpy.where(active, value, 0 if frame.value is None else frame.value)
+                frame.returned = active if frame.returned is None else frame.returned | active
+        elif node_type == 'FUNCTION_CALL':
+            self.call_function(node[1], node[2], env, active)
+        elif node_type in ('EXPR', 'PRINT', 'IF'):
+            raise BatchUnsupported(f'{node_type} statements')
+        else:
+            self.evaluate(node, env, active)
+
+    def evaluate(self, expr, env, active):
+        expr = strip_position(expr)
+        if type(expr) is bool or type(expr) is int or type(expr) is float:
+            return expr
+        elif type(expr) is str:
+            if expr[:1].isdigit():
+                return parse_number(expr)
+            return env.get(expr, 0)
+        elif type(expr) is tuple:
+            tag = expr[0]
+            if tag == 'FUNCTION_CALL':
+                return self.call_function(expr[1], expr[2], env, active)
+            elif tag == 'COMPARE':
+                _, op, left, right = expr
+                return COMPARE_OPERATORS[op](self.evaluate(left, env, active), self.evaluate(right, env, active))
+            elif tag == 'COMMA':
+                value = None
+                for item in expr[1]:
+                    value = self.evaluate(item, env, active)
+                return value
+            elif len(expr) == 3 and tag in BINARY_OPERATORS:
+                return self.binary(tag, self.evaluate(expr[1], env, active), self.evaluate(expr[2], env, active))
+        raise BatchUnsupported(f'expression {expr!r}')
+
+    def binary(self, op, left, right):
+        function = BINARY_OPERATORS[op]
+        if op != '/' and self.is_integer(left) and self.is_integer(right):
+            # numpy integers wrap silently where scalar Python ints grow, so redo the
+            # operation in float64 and leave anything near the int64 range to the rows
+            estimate = function(numpy.asarray(left, numpy.float64), numpy.asarray(right, numpy.float64))
+            if numpy.any(numpy.abs(estimate) >= 2.0 ** 62):
+                raise BatchUnsupported(f'integer overflow in {op}')
+        return function(left, right)
+
+    def is_integer(self, value):
+        if isinstance(value, numpy.ndarray):
+            return value.dtype.kind in 'biu'
+        return type(value) is int or type(value) is bool or isinstance(value, numpy.integer)
+
+    def call_function(self, func_name, args, env, active):
+        if func_name not in self.functions:
+            if self.builtins is not None and func_name in self.builtins.builtins:
+                raise BatchUnsupported(f'builtin {func_name}')
+            return None
+        params, body = self.functions[func_name]
+        local_env = dict(env)
+        for param, arg in zip(params, flatten_arguments(args)):
+            local_env[param] = self.evaluate(arg, env, active)
+        frame = BatchFrame()
+        self.run(body[1], local_env, active, frame)
+        if frame.returned is None:
+            raise BatchUnsupported(f'{func_name} returns no value')
+        missing = ~frame.returned if active is None else active & ~frame.returned
+        if missing.any():
+            raise BatchUnsupported(f'{func_name} returns no value for some rows')
+        return frame.value
+
+class JobTimeout(RuntimeError):
+    pass
+
+WORKER_PROGRAMS = {}
+WORKER_DIRECTORY = None
+WORKER_TIMEOUT = None
+WORKER_BUILTINS = None
+
+def init_worker(directory, timeout, builtins=None):
+    global WORKER_DIRECTORY, WORKER_TIMEOUT, WORKER_BUILTINS
+    WORKER_PROGRAMS.clear()
+    WORKER_DIRECTORY = directory
+    WORKER_TIMEOUT = timeout
+    WORKER_BUILTINS = builtins
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, raise_job_timeout)
+
+def worker_program(handle):
+    # each worker unpickles a program the first time one of its jobs names it
+    program = WORKER_PROGRAMS.get(handle)
+    if program is None:
+        with open(os.path.join(WORKER_DIRECTORY, f'{handle}.pickle'), 'rb') as file:
+            program = WORKER_PROGRAMS[handle] = pickle.load(file)
+    return program
+
+def raise_job_timeout(signum, frame):
+    if frame is not None and frame.f_code is run_job.__code__:
+        # the job has not entered execute yet or has just returned from it; run_job
+        # disarms the timer right after execute, so a retry only fires in the first case
+        signal.setitimer(signal.ITIMER_REAL, 0.001)
+        return
+    message = f'Job exceeded {WORKER_TIMEOUT}s'
+    raise JobTimeout(message)
+
+def run_job(job):
+    index, handle, variables = job
+    try:
+        executor = GScriptExecutor(worker_program(handle), WORKER_BUILTINS)
+    except Exception as error:
+        return index, None, None, f'{type(error).__name__}: {error}'
+    executor.variables = dict(variables)
+    if WORKER_TIMEOUT is not None:
+        signal.setitimer(signal.ITIMER_REAL, WORKER_TIMEOUT)
+    try:
+        value = executor.execute()
+    except Exception as error:
+        if WORKER_TIMEOUT is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        return index, None, None, f'{type(error).__name__}: {error}'
+    if WORKER_TIMEOUT is not None:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    return index, executor.variables, value, None
+
+class ScriptPool:
+    # runs (program, variables) jobs across worker processes. Each registered program is
+    # pickled once into a private directory and jobs name it by handle, so only the
+    # variables travel per job. Workers load a program the first time they need it, so
+    # registering one does not restart them. The builtin registry travels through the
+    # pool initializer, so its functions must pickle
+    def __init__(self, processes=None, timeout=None, chunksize=1, builtins=None) -> None:
+        self.processes = processes or os.cpu_count() or 1
+        self.timeout = timeout
+        self.chunksize = chunksize
+        self.builtins = builtins
+        self.programs = []
+        self.handles = {}
+        self.pool = None
+        self.directory = tempfile.mkdtemp(prefix='gscript-pool-')
+        self.cleanup = weakref.finalize(self, shutil.rmtree, self.directory, True)
+    
+    def register(self, ast):
+        # programs stay referenced so their ids are not reused by other objects
+        handle = self.handles.get(id(ast))
+        if handle is None:
+            handle = len(self.programs)
+            with open(os.path.join(self.directory, f'{handle}.pickle'), 'wb') as file:
+                pickle.dump(ast, file, pickle.HIGHEST_PROTOCOL)
+            self.programs.append(ast)
+            self.handles[id(ast)] = handle
+        return handle
+    
+    def start(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes, init_worker, (self.directory, self.timeout, self.builtins))
+        return self.pool
+    
+    def imap(self, jobs, chunksize=None):
+        # yields (index, variables, value, error) in completion order, index being the
+        # job's position in jobs; error is None or a message such as 'JobTimeout: ...'
+        tasks = []
+        for index, (program, variables) in enumerate(jobs):
+            handle = program if type(program) is int else self.register(program)
+            if not 0 <= handle < len(self.programs):
+                message = f'Unknown program handle {handle}'
+                raise RuntimeError(message)
+            tasks.append((index, handle, variables or {}))
+        pool = self.start()
+        yield from pool.imap_unordered(run_job, tasks, chunksize or self.chunksize)
+    
+    def map(self, jobs, chunksize=None):
+        results = [None] * len(jobs)
+        for result in self.imap(jobs, chunksize):
+            results[result[0]] = result
+        return results
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+    
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.terminate()
+        self.cleanup()
+
+STATEMENT_SCAN = re.compile(r'"[^"]*"?|[{}();]')
+ELSE_AHEAD = re.compile(r'\s*(else\b|;)?')
+
+class StatementStream:
+    # parses a file, mmap or string one top-level statement at a time. A scan over quotes,
+    # braces, parentheses and semicolons finds where each statement ends, so only the
+    # statement being parsed is ever lexed and held in memory
+    def __init__(self, source, plugins, chunk_size=1 << 20, builtins=None) -> None:
+        if type(source) is str:
+            source = io.StringIO(source)
+        self.source = source
+        self.owns_source = False
+        self.chunk_size = chunk_size
+        self.decoder = None
+        self.parser = GScriptParser('', builtins=builtins)
+        for plugin in plugins:
+            self.parser.register_plugin(plugin)
+        self.statements = 0
+        self.bytes_read = 0
+        self.max_statement = 0
+    
+    @classmethod
+    def open(cls, path, plugins, chunk_size=1 << 20, builtins=None):
+        # the stream closes the file at its end, on close() or when its with block exits
+        stream = cls(open(path, 'rb'), plugins, chunk_size, builtins)
+        stream.owns_source = True
+        return stream
+    
+    def close(self):
+        if self.owns_source:
+            self.source.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def read(self):
+        chunk = self.source.read(self.chunk_size)
+        if type(chunk) is not str:
+            if self.decoder is None:
+                self.decoder = codecs.getincrementaldecoder('utf-8')()
+            self.bytes_read += len(chunk)
+            return self.decoder.decode(chunk, final=not chunk)
+        self.bytes_read += len(chunk)
+        return chunk
+    
+    def texts(self):
+        buffer = ''
+        start = scan = 0
+        braces = parens = 0
+        eof = False
+        while True:
+            match = STATEMENT_SCAN.search(buffer, scan)
+            cut = None
+            more = match is None
+            if more:
+                scan = len(buffer)
+            else:
+                token = match.group()
+                if token[0] == '"':
+                    # a string cut off by the chunk end is scanned again from its quote
+                    more = not eof and (len(token) == 1 or token[-1] != '"')
+                    if not more:
+                        scan = match.end()
+                elif token == '}' and braces == 1 and parens == 0:
+                    # an else or a stray ; after the closing brace belongs to this statement
+                    ahead = ELSE_AHEAD.match(buffer, match.end())
+                    more = not eof and ahead.end() + 5 > len(buffer)
+                    if not more:
+                        braces = 0
+                        scan = match.end()
+                        if ahead.group(1) != 'else':
+                            cut = ahead.end() if ahead.group(1) == ';' else scan
+                else:
+                    scan = match.end()
+                    if token == '{':
+                        braces += 1
+                    elif token == '}':
+                        braces -= 1
+                    elif token == '(':
+                        parens += 1
+                    elif token == ')':
+                        parens -= 1
+                    elif braces == 0 and parens == 0:
+                        cut = scan
+            if cut is not None:
+                text = buffer[start:cut]
+                start = scan = cut
+                if text.strip():
+                    yield text
+            elif more:
+                if eof:
+                    text = buffer[start:]
+                    if text.strip():
+                        yield text
+                    return
+                # keep only the unfinished statement and scan on from where we stopped
+                buffer = buffer[start:]
+                scan -= start
+                start = 0
+                chunk = self.read()
+                eof = not chunk
+                if eof:
+                    self.close()
+                buffer += chunk
+    
+    def __iter__(self):
+        parser = self.parser
+        for text in self.texts():
+            if len(text) > self.max_statement:
+                self.max_statement = len(text)
+            parser.reset(text)
+            for node in parser.parse():
+                self.statements += 1
+                yield node
+    
+    def execute(self, executor=None):
+        # runs statements as they are parsed; returns the value of a top-level return
+        if executor is None:
+            executor = GScriptExecutor([], self.parser.builtins)
+        self.executor = executor
+        definitions = executor.ast = []
+        for node in self:
+            if node[0] == 'FUNCTION_DEF':
+                # scopes are resolved against the definitions seen so far
+                definitions.append(node)
+                executor.resolver = None
+                executor.frame_pools = {}
+            result = executor.execute_node(node)
+            if type(result) is tuple:
+                return result[1]
@@ -1,13 +1,97 @@
+import asyncio
+import os
+import tempfile
+import time
+
+from gscript import ASTOptimizer
 from gscript import AssignmentParser
+from gscript import AsyncExecutor
+from gscript import BatchExecutor
+from gscript import BudgetExceeded
 from gscript import ExpressionParser
 from gscript import ConditionParser
+from gscript import FunctionMemo
+from gscript import LazyBody
 from gscript import LoopParser
 from gscript import FunctionParser
 from gscript import FunctionCallParser
 from gscript import GScriptParser
 from gscript import GScriptExecutor
+from gscript import GScriptVM
+from gscript import ImportParser
+from gscript import Meter
+from gscript import ModuleLoader
+from gscript import NodeArena
+from gscript import Profiler
+from gscript import ProgramCache
+from gscript import PythonTranspiler
 from gscript import ReturnParser
+from gscript import ScriptPool
+from gscript import StatementStream
+from gscript import TieredExecutor
+from gscript import TypedExecutor
 from gscript import VarExpressionParser
+from gscript import count_nodes
+from gscript import nodes_from_tuples
+from gscript import nodes_to_tuples
+from gscript import standard_builtins
+
+
+PLUGINS = [FunctionParser, FunctionCallParser, ReturnParser, ConditionParser, LoopParser,
+           VarExpressionParser, AssignmentParser, ExpressionParser]
+
+def parse(code, plugins=PLUGINS, **options):
+    parser = GScriptParser(code, **options)
+    for plugin in plugins:
+        parser.register_plugin(plugin)
+    return parser, parser.parse()
+
+
+SAMPLE = """
+function add(a, b) { return a + b; }
+function fib(n) { if (n < 2) { return n; } return fib(n - 1) + fib(n - 2); }
+var x = add(2, 3);
+var f = fib(12);
+for (i = 0; i < 4; i = i + 1) { x = x + i; }
+"""
+
+def run(ast, executor_class=GScriptExecutor, **options):
+    executor = executor_class(ast, **options)
+    executor.execute()
+    return executor.variables
+
+async def double(value):
+    await asyncio.sleep(0)
+    return value * 2
+
+def located(node, spans):
+    # the node with every token position replaced by the source span it points at
+    if type(node) is tuple and len(node) == 2 and type(node[1]) is int:
+        return (located(node[0], spans), spans.span(node[1]))
+    if type(node) is tuple or type(node) is list or type(node) is LazyBody:
+        return [located(item, spans) for item in node]
+    return node
+
+def reparse_seconds(statements):
+    # median time of one edit in the middle of a file of the given number of statements
+    names = [''.join(chr(ord('a') + int(digit)) for digit in str(i)) for i in range(statements // 2)]
+    code = ''.join(f'function f{name}(a) {{ return a + 1; }}\nvar v{name} = f{name}(2);\n' for name in names)
+    parser, _ = parse(code)
+    middle = f'var v{names[len(names) // 2]} = f{names[len(names) // 2]}('
+    start = code.index(middle) + len(middle)
+    times = []
+    for edit in range(41):
+        began = time.perf_counter()
+        parser.reparse(start, start + 1, '3' if edit % 2 else '2')
+        times.append(time.perf_counter() - began)
+    return sorted(times)[len(times) // 2], parser.last_reparse['mode']
+
+def parse_request(code):
+    parser = GScriptParser(code)
+    for plugin in PLUGINS:
+        parser.register_plugin(plugin)
+    parser.declare_function('add', ['a', 'b'])
+    return parser.parse()
 
 
 if __name__=="__main__":
@@ -83,6 +167,19 @@ if __name__=="__main__":
         } else {
             print("Result is 5 or less");
         }
+        """,
+        
+        # loops
+        """
+        var i = 0;
+        var s = 0;
+        while (i < 10) {
+            s = s + i * 2 - (i - 1) * 3;
+            i = i + 1;
+        }
+        for (j = 0; j < 3; j = j + 1) {
+            s = s + j;
+        }
         """
     ]
     
@@ -99,4 +196,279 @@ if __name__=="__main__":
         parser.register_plugin(ExpressionParser)
         ast = parser.parse()
         print("ast:", ast)
-
+        
+        executor = GScriptExecutor(ast)
+        executor.execute()
+        vm = GScriptVM(ast)
+        vm.execute()
+        variables = {}
+        PythonTranspiler(parser.spans).transpile(ast).execute(variables)
+        typed = TypedExecutor(ast)
+        typed.execute()
+        tiered = TieredExecutor(ast, threshold=1)
+        tiered.execute()
+        print("variables:", executor.variables, "vm:", vm.variables == executor.variables,
+              "python:", variables == executor.variables, "typed:", typed.variables == executor.variables,
+              "tiered:", tiered.variables == executor.variables)
+    
+    # import
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'mathlib.gs'), 'w') as file:
+            file.write("function square(x) { return x * x; }")
+        loader = ModuleLoader(PLUGINS, path=[directory])
+        parser = GScriptParser('import "mathlib"; var r = square(7);')
+        parser.loader = loader
+        for plugin in [ImportParser] + PLUGINS:
+            parser.register_plugin(plugin)
+        ast = parser.parse()
+        executor = GScriptExecutor(ast)
+        executor.loader = loader
+        executor.execute()
+        optimized = ASTOptimizer().optimize(ast)
+        arena, roots = NodeArena.from_nodes(nodes_from_tuples(ast))
+        print("import:", executor.variables == {'r': 49}, "optimized:", optimized[0] == ('IMPORT', 'mathlib'),
+              "nodes:", count_nodes(ast), "arena:", nodes_to_tuples(arena.to_nodes(roots)) == nodes_to_tuples(nodes_from_tuples(ast)))
+        vm = GScriptVM(ast, loader=loader)
+        vm.execute()
+        variables = {}
+        PythonTranspiler(loader=loader).transpile(ast).execute(variables)
+        parser = GScriptParser('import "mathlib"; function f(a) { return square(a) + 1; } var r = f(3); '
+                               'var s = square(2); function square(x) { return x; } var t = square(2);')
+        parser.loader = loader
+        for plugin in [ImportParser] + PLUGINS:
+            parser.register_plugin(plugin)
+        ast = parser.parse()
+        expected = {'r': 10, 's': 4, 't': 2}
+        vm_shadowed = GScriptVM(ast, loader=loader)
+        vm_shadowed.execute()
+        shadowed = {}
+        PythonTranspiler(loader=loader).transpile(ast).execute(shadowed)
+        print("import engines:", vm.variables == {'r': 49}, variables == {'r': 49},
+              vm_shadowed.variables == expected, shadowed == expected)
+    
+    # packrat
+    _, plain = parse(SAMPLE)
+    _, memoized = parse(SAMPLE, packrat=True)
+    print("packrat:", memoized == plain, run(memoized) == run(plain))
+    
+    # arena
+    nodes = nodes_from_tuples(plain)
+    arena, roots = NodeArena.from_nodes(nodes)
+    print("arena:", arena.to_nodes(roots) == nodes, run(nodes_to_tuples(arena.to_nodes(roots))) == run(plain), len(arena) == count_nodes(plain))
+    
+    # optimizer
+    _, ast = parse(SAMPLE + "function none(a) { } var y = none(add(1, 2)); var z = 2 * 3 + 1; if (1 > 2) { z = 0; }", lazy_functions=True)
+    optimizer = ASTOptimizer()
+    optimized = optimizer.optimize(ast)
+    untouched = not any(node[3].resolved for node in ast if node[0] == 'FUNCTION_DEF' and type(node[3]) is LazyBody)
+    print("optimizer:", run(optimized) == run(ast), optimizer.report['nodes_after'] < optimizer.report['nodes_before'],
+          "lazy:", untouched)
+    
+    # cache
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ProgramCache(PLUGINS, directory=directory)
+        first, second = cache.parse(SAMPLE), cache.parse(SAMPLE)
+        first.clear()
+        warm = ProgramCache(PLUGINS, directory=directory).parse(SAMPLE)
+        print("cache:", second == plain, cache.parse(SAMPLE) == plain, warm == plain, cache.stats()['hits'], run(warm) == run(plain))
+        # a file that cannot be written leaves no temporary behind and still parses
+        code = "var unwritable = 1;"
+        os.mkdir(cache.path(cache.key(code)))
+        print("cache write error:", cache.parse(code) == parse(code)[1], not any(name.endswith('.tmp') for name in os.listdir(directory)))
+    builtins = standard_builtins()
+    cached = ProgramCache(PLUGINS, builtins=builtins).parse("var r = sqrt(16);")
+    print("cached builtins:", run(cached, builtins=builtins) == {'r': 4.0})
+    
+    # batch
+    for code in ("var y = n * n + 1; if (n > 1) { y = y - n; }", "var y = n * 1000000000 * 1000000000 * 1000000000;"):
+        _, ast = parse(code)
+        batch = BatchExecutor(ast)
+        columns = batch.execute_batch({'n': [1, 2, 3]})
+        expected = []
+        for n in (1, 2, 3):
+            executor = GScriptExecutor(ast)
+            executor.variables = {'n': n}
+            executor.execute()
+            expected.append(executor.variables['y'])
+        print("batch:", batch.mode, [int(value) for value in columns['y']] == expected)
+    
+    # pool
+    builtins = standard_builtins()
+    _, ast = parse("var x = sqrt(n) + n;", builtins=builtins)
+    expected = []
+    for n in (4, 9, 16):
+        executor = GScriptExecutor(ast, builtins)
+        executor.variables = {'n': n}
+        executor.execute()
+        expected.append(executor.variables)
+    with ScriptPool(2, timeout=1.0, builtins=builtins) as pool:
+        results = pool.map([(ast, {'n': n}) for n in (4, 9, 16)])
+        workers = pool.pool
+        # a program registered after the workers started reaches them without a restart
+        _, slow = parse("var i = 0; while (i < 1) { i = i * 1; }")
+        late = pool.map([(slow, {}), (plain, {})])
+        print("pool:", [result[1] for result in results] == expected, [result[3] for result in results] == [None] * 3,
+              pool.pool is workers, late[0][3].startswith('JobTimeout'), late[1][1] == run(plain), late[1][3] is None)
+    
+    # async
+    parser = GScriptParser(SAMPLE + "var d = double(x);")
+    for plugin in PLUGINS:
+        parser.register_plugin(plugin)
+    parser.declare_function('double', ['value'])
+    executor = AsyncExecutor(parser.parse(), hosts={'double': double}, yield_every=2)
+    asyncio.run(executor.execute())
+    expected = run(plain)
+    expected['d'] = expected['x'] * 2
+    print("async:", executor.variables == expected, executor.steps > 0)
+    
+    # meter
+    meter = Meter(max_steps=50, check_every=8)
+    try:
+        meter.install(GScriptExecutor(plain)).execute()
+        stopped = None
+    except BudgetExceeded as error:
+        stopped = error.kind
+    meter = Meter(max_depth=3)
+    kinds = []
+    for _ in range(2):
+        try:
+            meter.install(GScriptExecutor(plain)).execute()
+        except BudgetExceeded as error:
+            kinds.append(error.kind)
+    unlimited = Meter()
+    executor = unlimited.install(GScriptExecutor(plain))
+    executor.execute()
+    print("meter:", stopped, kinds, executor.variables == run(plain), unlimited.usage()['max_depth'] > 3)
+    # each run gets a fresh budget, so a budget that fits one run fits every run
+    meter = Meter(max_steps=unlimited.usage()['steps'] + 10, max_seconds=60)
+    executor = meter.install(GScriptExecutor(plain))
+    executor.execute()
+    executor.execute()
+    print("meter reused:", meter.install(GScriptExecutor(plain)).execute() is None, meter.usage()['steps'] <= meter.max_steps)
+    # async runs are metered too
+    parser = GScriptParser(SAMPLE + "var d = double(x);")
+    for plugin in PLUGINS:
+        parser.register_plugin(plugin)
+    parser.declare_function('double', ['value'])
+    ast = parser.parse()
+    kinds = []
+    for meter in (Meter(max_steps=50), Meter(max_depth=3)):
+        try:
+            asyncio.run(meter.install(AsyncExecutor(ast, hosts={'double': double})).execute())
+        except BudgetExceeded as error:
+            kinds.append(error.kind)
+    # a compiled loop never sees a meter, so installing one while it runs is refused
+    builtins = standard_builtins()
+    tiered = None
+    def arm(i):
+        if i == 150:
+            Meter().install(tiered)
+        return i
+    builtins.register('arm', arm, 1, 1)
+    _, ast = parse("var i = 0; while (i < 200) { i = i + 1; arm(i); }", builtins=builtins)
+    tiered = TieredExecutor(ast, builtins)
+    try:
+        tiered.execute()
+        refused = False
+    except RuntimeError as error:
+        refused = 'compiled loop' in str(error)
+    print("meter async:", kinds, "tiered refused:", refused)
+    
+    # profiler
+    parser, ast = parse(SAMPLE)
+    profiler = Profiler(parser.spans)
+    executor = profiler.install(GScriptExecutor(ast))
+    executor.execute()
+    calls = {func_name: entry[0] for func_name, entry in profiler.functions.items()}
+    print("profiler:", calls == {'<program>': 1, 'add': 1, 'fib': 465}, executor.variables == run(plain),
+          '<program>;fib;fib ' in profiler.collapsed())
+    
+    # reparse
+    parser, _ = parse(SAMPLE)
+    code = SAMPLE
+    matches = []
+    for old, new in (("fib(12)", "fib(10)"), ("x + i", "x + i * 2"), ("var f", "var g = 1; var f")):
+        start = code.index(old)
+        edited = parser.reparse(start, start + len(old), new)
+        code = code[:start] + new + code[start + len(old):]
+        fresh_parser, fresh = parse(code)
+        matches.append((parser.last_reparse['mode'], located(edited, parser.spans) == located(fresh, fresh_parser.spans)
+                        and run(edited) == run(fresh)))
+    print("reparse:", matches)
+    (small, small_mode), (large, large_mode) = reparse_seconds(400), reparse_seconds(4000)
+    print("reparse scaling:", small_mode, large_mode, large < 3 * small)
+    
+    # stream
+    stream = StatementStream(SAMPLE, PLUGINS, chunk_size=7)
+    stream.execute()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sample.gs')
+        with open(path, 'w') as file:
+            file.write(SAMPLE)
+        with StatementStream.open(path, PLUGINS, chunk_size=5) as streamed:
+            nodes = list(streamed)
+            closed_at_end = streamed.source.closed
+        with StatementStream.open(path, PLUGINS, chunk_size=5) as partial:
+            next(iter(partial))
+        print("stream closed:", closed_at_end, partial.source.closed)
+    print("stream:", stream.executor.variables == run(plain), stream.statements == len(plain),
+          run(nodes) == run(plain), streamed.bytes_read == len(SAMPLE))
+    
+    # memo
+    _, ast = parse(SAMPLE + "var k = 1; function scale(a) { return a * k; } var s = scale(2); k = 3; s = s + scale(2);")
+    memo = FunctionMemo(ast)
+    executor = memo.install(GScriptExecutor(ast))
+    executor.execute()
+    stats = memo.stats()
+    print("memo:", executor.variables == run(ast), stats['fib']['hits'] > 0, stats['fib']['misses'] == 13, executor.variables['s'] == 8)
+    
+    # snapshot
+    executor = GScriptExecutor(plain)
+    executor.execute()
+    snapshot = executor.snapshot()
+    executor.variables['x'] = -1
+    before = dict(snapshot.variables)
+    first, _ = snapshot.run(parse_request("x = 100; var y = add(x, 1);"))
+    second, _ = snapshot.run(parse_request("function add(a, b) { return a - b; } var y = add(x, 1);"))
+    third, _ = snapshot.run(parse_request("var y = add(x, 1);"))
+    print("snapshot:", first == {'x': 100, 'y': 101}, second == {'y': before['x'] - 1}, third == {'y': before['x'] + 1},
+          dict(snapshot.variables) == before == run(plain))
+    
+    # dispatch: plugins the in-order loop would have tried before the one that matched
+    skipped = [parse(code)[0].stats()['skipped_attempts'] for code in ("var x = 1;", "var x = 1; x = 2;", "return 1;", "if (1 > 2) { return 1; }")]
+    print("dispatch:", skipped == [4, 8, 2, 4])
+    
+    # transpiler globals read before their first assignment
+    builtins = standard_builtins()
+    _, ast = parse("function same(a) { return a; } var y = max(same(z), 0); var r = z; if (r > 0) { z = 1; }", builtins=builtins)
+    variables = {}
+    PythonTranspiler(builtins=builtins).transpile(ast).execute(variables)
+    print("unassigned:", variables == run(ast, builtins=builtins) == {'y': 0, 'r': 0}, type(variables['y']) is int)
+    
+    # lazy bodies parse against the functions defined before them, like eager bodies
+    code = "function a() { return b(1); } function b(x) { return x; } var r = a();"
+    _, lazy = parse(code, lazy_functions=True)
+    _, ast = parse(SAMPLE, lazy_functions=True)
+    print("lazy scope:", lazy == parse(code)[1], run(ast) == run(plain))
+    
+    # a script function shadows a builtin only from its definition on, in every engine
+    builtins = standard_builtins()
+    _, ast = parse("var a = sqrt(16); function sqrt(x) { return x + 1; } var b = sqrt(16);", builtins=builtins)
+    vm = GScriptVM(ast, builtins)
+    vm.execute()
+    variables = {}
+    PythonTranspiler(builtins=builtins).transpile(ast).execute(variables)
+    expected = {'a': 4.0, 'b': 17}
+    print("shadowed builtin:", run(ast, builtins=builtins) == expected, vm.variables == expected, variables == expected,
+          run(ast, TypedExecutor, builtins=builtins) == expected, run(ast, TieredExecutor, builtins=builtins) == expected)
+    
+    # typed closures
+    _, ast = parse(SAMPLE)
+    typed = TypedExecutor(ast)
+    typed.compiled_limit = 8
+    typed.execute()
+    bounded = len(typed.compiled) <= 8
+    for value in range(100):
+        typed.evaluate_expression(('+', str(value), '1'))
+    print("typed closures:", typed.variables == run(ast), bounded, len(typed.compiled) <= 8,
+          typed.evaluate_expression(('*', '6', '7')) == 42)